@@ -14,10 +14,14 @@ __version__ = "1.3"
 
 import os
 import re
+import sys
 import gzip
 import zlib
+import shutil
 import struct
 import StringIO
+import tempfile
+import multiprocessing
 
 import lzss
 import binlz
@@ -55,13 +59,7 @@ def isJapanese(version):
 
 # Retrieve a file from a disc image.
 def _retrieveFileFromImage(image, subDir, fileName):
-    filePath = subDir + '/' + fileName
-
-    data = image.readFile(filePath)
-
-    f = StringIO.StringIO(data)
-    f.name = filePath  # kernel.Archive needs this
-    return f
+    return image.openFile(subDir + '/' + fileName)
 
 
 # Retrieve a file from a disc directory.
@@ -163,10 +161,12 @@ def decompressGzip(data):
     return zipper.read()
 
 
-# Compress an 8-bit string to GZIP format.
-def compressGzip(data):
+# Compress an 8-bit string to GZIP format. The 'memLevel', 'strategy', and
+# 'windowBits' are passed to zlib (memLevel = 6 seems to produce smaller
+# output than the default).
+def compressGzip(data, memLevel = 6, strategy = zlib.Z_DEFAULT_STRATEGY, windowBits = zlib.MAX_WBITS):
     buffer = StringIO.StringIO()
-    zipper = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS, 6, 0)  # memlevel = 6 seems to produce smaller output
+    zipper = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -windowBits, memLevel, strategy)
 
     buffer.write("\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x00")
     buffer.write(zipper.compress(data))
@@ -182,9 +182,118 @@ def decompressLzss(data):
     return lzss.decompress(data)
 
 
-# Compress an 8-bit string to LZSS format.
-def compressLzss(data):
-    return lzss.compress(data)
+# Compress an 8-bit string to LZSS format. The 'level' may be lzss.FAST,
+# lzss.LAZY, or lzss.OPTIMAL.
+def compressLzss(data, level = lzss.FAST):
+    return lzss.compress(data, level)
+
+
+# Apply a function to all items of a list and return the list of results,
+# in order. If 'workers' is greater than 1, the items are processed in
+# parallel by a pool of that many processes; the function must then be
+# defined at module level so it can be passed to the worker processes.
+def parallelMap(func, items, workers = 1):
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    pool = multiprocessing.Pool(min(workers, len(items)))
+    try:
+        results = pool.map(func, items)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
+# Output written to sys.stdout or sys.stderr by a task running in a worker
+# process, recorded as a list of (isError, text) tuples.
+class _OutputRecorder:
+    def __init__(self, output, isError):
+        self.output = output
+        self.isError = isError
+
+    def write(self, text):
+        self.output.append((self.isError, text))
+
+
+# Run a (func, args) task in a worker process. Returns the tuple (result,
+# output, exception).
+def _runTask(task):
+    func, args = task
+
+    output = []
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = _OutputRecorder(output, False)
+    sys.stderr = _OutputRecorder(output, True)
+
+    try:
+        return (func(*args), output, None)
+    except Exception, e:
+        return (None, output, e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+# Call a function with each argument tuple of a list, yielding the results
+# in order. If 'workers' is greater than 1, the calls are made in parallel by
+# a pool of that many processes; the function must then be defined at module
+# level. Everything the function prints to sys.stdout and sys.stderr is
+# printed by the calling process in the order of the calls, just before the
+# corresponding result is yielded.
+def parallelTasks(func, argsList, workers = 1):
+    if workers <= 1:
+        for args in argsList:
+            yield func(*args)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result, output, e in pool.imap(_runTask, ((func, args) for args in argsList)):
+            for isError, text in output:
+                if isError:
+                    sys.stderr.write(text)
+                else:
+                    sys.stdout.write(text)
+
+            if e is not None:
+                raise e
+
+            yield result
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# Write data to a file, atomically replacing any existing file of that name.
+def writeFileAtomically(filePath, data):
+    dirName, fileName = os.path.split(filePath)
+
+    f = tempfile.NamedTemporaryFile(dir = dirName or ".", prefix = fileName + ".", delete = False)
+    try:
+        f.write(data)
+        f.close()
+
+        # Give the file the same permissions as open() would
+        if os.path.exists(filePath):
+            shutil.copymode(filePath, f.name)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(f.name, 0666 & ~umask)
+
+        os.rename(f.name, filePath)
+    except:
+        f.close()
+        os.remove(f.name)
+        raise
 
 
 # Decode FF7 kernel text string to unicode string.
@@ -207,6 +316,7 @@ def encodeFieldText(text, japanese = False):
     return ff7text.encode(text, True, japanese)
 
 
-# Calculate the extent of a unicode string.
+# Calculate the extent of a unicode string. The 'metrics' argument is either
+# a TextMetrics object or an array of font metrics data.
 def textExtent(text, metrics):
     return ff7text.extent(text, metrics)
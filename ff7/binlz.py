@@ -13,25 +13,48 @@ import struct
 import ff7
 
 
+# Compress file data for storing it in an archive.
+def _compressFile(data):
+    cmpData = ff7.compressLzss(data)
+    cmpData = struct.pack("<L", len(cmpData)) + cmpData
+
+    while len(cmpData) % 4:
+        cmpData += '\0'  # align to 32-bit
+
+    return cmpData
+
+
 # LZSS archive file, stores LZSS compressed data
 class ArchiveFile:
 
     def __init__(self, index, cmpData = ""):
         self.index = index
-        self.cmpData = cmpData
+        self.cmpData = cmpData  # compressed data, None if it needs to be recompressed
+        self.data = None        # decompressed data, None if not decompressed yet
 
     # Return the decompressed file data as an 8-bit string.
     def getData(self):
-        cmpSize = struct.unpack_from("<L", self.cmpData)[0]
-        return ff7.decompressLzss(self.cmpData[4:4 + cmpSize])
+        if self.data is None:
+            cmpSize = struct.unpack_from("<L", self.cmpData)[0]
+            self.data = ff7.decompressLzss(self.cmpData[4:4 + cmpSize])
+
+        return self.data
 
-    # Replace the file data and compress it.
+    # Replace the file data. The data is only compressed when needed.
     def setData(self, data):
-        cmpData = ff7.compressLzss(data)
-        self.cmpData = struct.pack("<L", len(cmpData)) + cmpData
+        if self.cmpData and data == self.getData():
+            return  # unchanged, keep the original compressed data
 
-        while len(self.cmpData) % 4:
-            self.cmpData += '\0'  # align to 32-bit
+        self.data = data
+        self.cmpData = None
+
+    # Return the compressed file data (including the size header and
+    # alignment) as an 8-bit string.
+    def getCmpData(self):
+        if self.cmpData is None:
+            self.cmpData = _compressFile(self.data)
+
+        return self.cmpData
 
 
 # LZSS archive (sequence of possibly LZSS compressed files with an offset
@@ -79,8 +102,18 @@ class Archive:
 
         self.fileList[f.index] = f
 
-    # Write the archive to a file object, truncating the file.
-    def writeToFile(self, fileobj):
+    # Write the archive to a file object, truncating the file. If 'workers'
+    # is greater than 1, changed files are compressed in parallel by that
+    # many processes.
+    def writeToFile(self, fileobj, workers = 1):
+
+        # Compress changed files
+        changed = [f for f in self.fileList if f.cmpData is None]
+        results = ff7.parallelMap(_compressFile, [f.data for f in changed], workers)
+
+        for f, cmpData in zip(changed, results):
+            f.cmpData = cmpData
+
         fileobj.seek(0)
         fileobj.truncate()
 
@@ -88,8 +121,8 @@ class Archive:
         offset = self.numFiles() * 4
         for f in self.fileList:
             fileobj.write(struct.pack("<L", offset))
-            offset += len(f.cmpData)
+            offset += len(f.getCmpData())
 
         # Write the file data
         for f in self.fileList:
-            fileobj.write(f.cmpData)
+            fileobj.write(f.getCmpData())
@@ -10,22 +10,290 @@
 
 
 import os
+import mmap
+import collections
 import struct
 
 
+# NumPy is optional, it speeds up the EDC/ECC calculation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Sync pattern at the start of each raw sector
+SYNC_PATTERN = "\x00\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00"
+
+# Number of bytes in a raw sector
+RAW_SECTOR_SIZE = 2352
+
+
+# Lookup tables for the EDC/ECC calculation of raw sectors
+_eccFLut = bytearray(256)
+_eccBLut = bytearray(256)
+_edcLut = []
+
+for i in xrange(256):
+    j = (i << 1) ^ (0x11d if i & 0x80 else 0)
+    _eccFLut[i] = j
+    _eccBLut[i ^ j] = i
+
+    edc = i
+    for j in xrange(8):
+        edc = (edc >> 1) ^ (0xd8018001 if edc & 1 else 0)
+    _edcLut.append(edc)
+
+
+# Calculate the EDC checksum of a byte string.
+def _edc(data):
+    edc = 0
+    for b in bytearray(data):
+        edc = (edc >> 8) ^ _edcLut[(edc ^ b) & 0xff]
+    return edc
+
+
+# Calculate one set (P or Q) of Reed-Solomon parity bytes for the ECC
+# block 'src', storing the results in 'dest'.
+def _eccBlock(src, majorCount, minorCount, majorMult, minorInc, dest):
+    size = majorCount * minorCount
+
+    for major in xrange(majorCount):
+        index = (major >> 1) * majorMult + (major & 1)
+        eccA = 0
+        eccB = 0
+
+        for minor in xrange(minorCount):
+            temp = src[index]
+            index += minorInc
+            if index >= size:
+                index -= size
+
+            eccA = _eccFLut[eccA ^ temp]
+            eccB ^= temp
+
+        eccA = _eccBLut[_eccFLut[eccA] ^ eccB]
+        dest[major] = eccA
+        dest[major + majorCount] = eccA ^ eccB
+
+
+# Fill in the EDC and ECC fields of a raw mode 2 sector given as a
+# bytearray. The sector form is taken from the sub-header.
+def _encodeSector(sector):
+    if sector[0x12] & 0x20:
+
+        # Form 2 sectors only have an EDC
+        struct.pack_into("<L", sector, 0x92c, _edc(buffer(sector, 0x10, 0x91c)))
+        return
+
+    struct.pack_into("<L", sector, 0x818, _edc(buffer(sector, 0x10, 0x808)))
+
+    # The ECC is calculated with the header address set to zero
+    block = sector[0x0c:0x8c8]
+    block[0:4] = "\0\0\0\0"
+
+    p = bytearray(172)
+    _eccBlock(block, 86, 24, 2, 86, p)
+    block[0x810:0x8bc] = p
+
+    q = bytearray(104)
+    _eccBlock(block, 52, 43, 86, 88, q)
+
+    sector[0x81c:0x8c8] = p
+    sector[0x8c8:0x930] = q
+
+
+if numpy is not None:
+
+    from numpy.lib.stride_tricks import as_strided
+
+    # Tables for calculating the EDC four bytes at a time
+    _edcLuts = [numpy.array(_edcLut, numpy.uint32)]
+    for i in xrange(3):
+        t = _edcLuts[-1]
+        _edcLuts.append((t >> 8) ^ _edcLuts[0].take(t & 0xff))
+
+    _eccBLutArray = numpy.frombuffer(_eccBLut, numpy.uint8)
+
+    # Calculate the EDC checksums of the rows of a 2-dimensional uint8
+    # array whose width is a multiple of four. Returns the checksums as a
+    # little-endian byte array.
+    def _edcMany(data):
+        t0, t1, t2, t3 = _edcLuts
+
+        # Process one 32-bit word of all rows at a time
+        words = numpy.ascontiguousarray(data).view("<u4").T.copy()
+
+        edc = numpy.zeros(data.shape[0], numpy.uint32)
+        for word in words:
+            edc ^= word
+            edc = t3.take(edc & 0xff) ^ t2.take((edc >> 8) & 0xff) ^ t1.take((edc >> 16) & 0xff) ^ t0.take(edc >> 24)
+
+        return edc.astype("<u4").view(numpy.uint8).reshape(-1, 4)
+
+    # Multiply pairs of GF(2^8) elements packed into uint16 values by alpha.
+    def _mulAlphaMany(x):
+        return ((x << numpy.uint16(1)) & numpy.uint16(0xfefe)) ^ (((x >> numpy.uint16(7)) & numpy.uint16(0x0101)) * numpy.uint16(0x1d))
+
+    # Calculate one set of parity bytes for an array of ECC vectors given as
+    # a [sector, minor, major pair] uint16 array. Pairs of vectors are
+    # handled together, this works because the ECC never mixes bytes of
+    # different vectors.
+    def _parityMany(vectors):
+        eccA = numpy.zeros((vectors.shape[0], vectors.shape[2]), numpy.uint16)
+        eccB = numpy.bitwise_xor.reduce(vectors, axis = 1)
+
+        for minor in xrange(vectors.shape[1]):
+            eccA ^= vectors[:, minor]
+            eccA = _mulAlphaMany(eccA)
+
+        eccA = _eccBLutArray.take((_mulAlphaMany(eccA) ^ eccB).view(numpy.uint8))
+        eccB = eccB.view(numpy.uint8)
+
+        return numpy.concatenate((eccA, eccA ^ eccB), axis = 1)
+
+    # Fill in the EDC and ECC fields of raw mode 2 form 1 sectors given as a
+    # [sector, byte] uint8 array.
+    def _encodeForm1Many(sectors):
+        n = sectors.shape[0]
+        sectors[:, 0x818:0x81c] = _edcMany(sectors[:, 0x10:0x818])
+
+        # The ECC is calculated with the header address set to zero
+        block = sectors[:, 0x0c:0x8c8].copy()
+        block[:, 0:4] = 0
+        words = block.view(numpy.uint16)
+        stride = words.strides[0]
+
+        # P vectors: major byte at offset major + 86 * minor
+        p = _parityMany(as_strided(words, (n, 24, 43), (stride, 86, 2)))
+        block[:, 0x810:0x8bc] = p
+
+        # Q vectors: major byte at offset ((major >> 1) * 86 + (major & 1) +
+        # 88 * minor) modulo 2236, the repeated block avoids the modulo
+        repeated = numpy.empty((n, 3, 2236), numpy.uint8)
+        repeated[:] = block[:, numpy.newaxis, :]
+        words = repeated.reshape(n, -1).view(numpy.uint16)
+
+        q = _parityMany(numpy.ascontiguousarray(as_strided(words, (n, 43, 26), (words.strides[0], 88, 86))))
+
+        sectors[:, 0x81c:0x8c8] = p
+        sectors[:, 0x8c8:0x930] = q
+
+    # Fill in the EDC and ECC fields of raw mode 2 sectors given as a
+    # [sector, byte] uint8 array.
+    def _encodeMany(sectors):
+        form2 = (sectors[:, 0x12] & 0x20) != 0
+
+        if not form2.any():
+            _encodeForm1Many(sectors)
+            return
+
+        s = sectors[form2]
+        s[:, 0x92c:0x930] = _edcMany(s[:, 0x10:0x92c])
+        sectors[form2] = s
+
+        form1 = ~form2
+        if form1.any():
+            s = sectors[form1]
+            _encodeForm1Many(s)
+            sectors[form1] = s
+
+
+# Fill in the EDC and ECC fields of a sequence of raw mode 2 sectors given
+# as a byte string, according to the form specified in each sector's
+# sub-header. Returns the resulting data as a byte string.
+def encodeRawSectors(data):
+    if numpy is not None:
+        sectors = numpy.frombuffer(data, numpy.uint8).reshape(-1, RAW_SECTOR_SIZE).copy()
+        _encodeMany(sectors)
+        return sectors.tostring()
+
+    result = []
+    for offset in xrange(0, len(data), RAW_SECTOR_SIZE):
+        sector = bytearray(data[offset:offset + RAW_SECTOR_SIZE])
+        _encodeSector(sector)
+        result.append(str(sector))
+
+    return "".join(result)
+
+
+# Check the sync pattern, EDC, and ECC of a sequence of raw mode 2 sectors
+# given as a byte string. Returns a list of the indices of the bad sectors.
+# Form 2 sectors with an EDC of zero are accepted, as the EDC is optional
+# for them.
+def verifyRawSectors(data):
+    encoded = encodeRawSectors(data)
+    numSectors = len(data) / RAW_SECTOR_SIZE
+
+    if numpy is not None:
+        sectors = numpy.frombuffer(data, numpy.uint8).reshape(numSectors, RAW_SECTOR_SIZE)
+        expected = numpy.frombuffer(encoded, numpy.uint8).reshape(numSectors, RAW_SECTOR_SIZE)
+
+        form2 = (sectors[:, 0x12] & 0x20) != 0
+
+        good = (sectors[:, :12] == numpy.frombuffer(SYNC_PATTERN, numpy.uint8)).all(axis = 1)
+        good &= numpy.where(form2,
+                            (sectors[:, 0x92c:0x930] == expected[:, 0x92c:0x930]).all(axis = 1) | (sectors[:, 0x92c:0x930] == 0).all(axis = 1),
+                            (sectors[:, 0x818:0x930] == expected[:, 0x818:0x930]).all(axis = 1))
+
+        return [int(i) for i in numpy.flatnonzero(~good)]
+
+    badSectors = []
+    for i in xrange(numSectors):
+        offset = i * RAW_SECTOR_SIZE
+        sector = data[offset:offset + RAW_SECTOR_SIZE]
+
+        if ord(sector[0x12]) & 0x20:
+            good = sector[0x92c:0x930] in (encoded[offset + 0x92c:offset + 0x930], "\0\0\0\0")
+        else:
+            good = sector[0x818:0x930] == encoded[offset + 0x818:offset + 0x930]
+
+        if sector[:12] != SYNC_PATTERN or not good:
+            badSectors.append(i)
+
+    return badSectors
+
+
+# Convert a number to BCD.
+def _bcd(n):
+    return ((n / 10) << 4) | (n % 10)
+
+
 # Disc image object, handles 2048-byte-per-sector ISO images as well as
 # 2352-byte-per-sector "raw" mode 2 images.
 class Image:
 
-    # Open the specified image file and check for a valid ISO9660 file system.
-    def __init__(self, imageFileName):
+    # Number of raw sectors processed at once by verify() and resign()
+    batchSize = 1024
+
+    # Open the specified image file and check for a valid ISO9660 file
+    # system. If 'writable' is true, the image is opened for modification.
+    # The 'cacheSize' specifies the maximum number of sectors held in the
+    # sector cache.
+    def __init__(self, imageFileName, writable = False, cacheSize = 256):
         self.blockSize = None      # Number of bytes in one block (for seeking)
         self.blockOffset = None    # Offset of user data of first sector
+        self.numSectors = None     # Number of sectors in the image
+        self.map = None            # Memory-mapped image file, or None
         self.rootDirSector = None  # Root directory start sector
         self.rootDirSize = None    # Size of root directory extent
+        self.index = None          # Directory index
+        self.parsedDirs = None     # Directories contained in the index
+        self.records = None        # Locations of directory records
+        self.writable = writable   # Image opened for modification
+
+        # LRU cache of sector user data, mapping sector numbers to
+        # 2048-byte strings
+        self.cache = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.cacheHits = 0         # Number of sectors found in the cache
+        self.cacheMisses = 0       # Number of sectors read from the file
 
         # Open the file
-        self.file = open(imageFileName, "rb")
+        if writable:
+            self.file = open(imageFileName, "r+b")
+        else:
+            self.file = open(imageFileName, "rb")
 
         # Determine the image type
         header = self.file.read(12)
@@ -33,10 +301,10 @@ class Image:
         self.file.seek(0, os.SEEK_END)
         fileSize = self.file.tell()
 
-        if header == "\x00\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00" and fileSize % 2352 == 0:
+        if header == SYNC_PATTERN and fileSize % RAW_SECTOR_SIZE == 0:
 
             # Sync header present, assume a raw image
-            self.blockSize = 2352
+            self.blockSize = RAW_SECTOR_SIZE
             self.blockOffset = 0x18
 
         elif fileSize % 2048 == 0:
@@ -48,6 +316,19 @@ class Image:
         else:
             raise EnvironmentError, "'%s' does not appear to be a disc image file (invalid file size)" % imageFileName
 
+        self.numSectors = fileSize / self.blockSize
+
+        # Map the file into memory if possible
+        try:
+            if writable:
+                access = mmap.ACCESS_WRITE
+            else:
+                access = mmap.ACCESS_READ
+
+            self.map = mmap.mmap(self.file.fileno(), 0, access = access)
+        except (EnvironmentError, ValueError, OverflowError):
+            self.map = None  # fall back to reading from the file
+
         # Read and check the PVD
         pvd = self.readExtent(16, 2048)
 
@@ -57,102 +338,484 @@ class Image:
         # Find the root directory
         self.rootDirSector, self.rootDirSize = struct.unpack_from("<L4xL", pvd, 0x9e)
 
+        # Set up the directory index
+        self.invalidateIndex()
+
     # Close the image file.
     def close(self):
+        if self.map is not None:
+            if self.writable:
+                self.map.flush()
+
+            self.map.close()
+            self.map = None
+
         self.file.close()
 
+    # Read 'numBlocks' complete blocks from the image, starting at block
+    # 'firstBlock'.
+    def readBlocks(self, firstBlock, numBlocks):
+        start = firstBlock * self.blockSize
+        end = start + numBlocks * self.blockSize
+
+        if self.map is not None:
+            return self.map[start:end]
+        else:
+            self.file.seek(start)
+            return self.file.read(end - start)
+
+    # Check that the given sector range lies within the image.
+    def checkSectors(self, firstSector, numSectors):
+        if firstSector + numSectors > self.numSectors:
+            raise ValueError, "Error reading sector %d of disc image" % max(firstSector, self.numSectors)
+
     # Read contiguous data from the image given the start sector and number
-    # of bytes to read. Returns the data as a byte string.
+    # of bytes to read. Returns the data as a byte string. Small extents are
+    # read through the sector cache.
     def readExtent(self, firstSector, numBytes):
-        data = ""
+        if numBytes <= 0:
+            return ""
+
+        numSectors = (numBytes + 2047) / 2048
+        self.checkSectors(firstSector, numSectors)
+
+        if numSectors > self.cacheSize / 4:
+            return self.readUncached(firstSector, numSectors, numBytes)
+
+        cache = self.cache
+        pieces = []
+
         sector = firstSector
+        endSector = firstSector + numSectors
 
-        while numBytes > 0:
-            self.file.seek(sector * self.blockSize + self.blockOffset)
-            sectorData = self.file.read(2048)
+        while sector < endSector:
+            data = cache.pop(sector, None)
 
-            if len(sectorData) < 2048:
-                raise ValueError, "Error reading sector %d of disc image" % sector
+            if data is not None:
 
-            sector += 1
+                # Cache hit, move sector to the end of the LRU list
+                self.cacheHits += 1
+                cache[sector] = data
+                pieces.append(data)
+                sector += 1
 
-            if numBytes > 2048:
-                data += sectorData
-                numBytes -= 2048
             else:
-                data += sectorData[:numBytes]
-                numBytes = 0
 
-        return data
+                # Cache miss, read all consecutive missing sectors at once
+                runEnd = sector + 1
+                while runEnd < endSector and runEnd not in cache:
+                    runEnd += 1
+
+                data = self.readUncached(sector, runEnd - sector, (runEnd - sector) * 2048)
+                self.cacheMisses += runEnd - sector
+
+                for offset in xrange(0, len(data), 2048):
+                    piece = data[offset:offset + 2048]
+                    cache[sector] = piece
+                    pieces.append(piece)
+                    sector += 1
+
+        # Evict the least recently used sectors
+        while len(cache) > self.cacheSize:
+            cache.popitem(last = False)
+
+        pieces[-1] = pieces[-1][:numBytes - (numSectors - 1) * 2048]
+        return "".join(pieces)
+
+    # Read contiguous data from the image given the start sector, number of
+    # sectors, and number of bytes to read, bypassing the sector cache.
+    def readUncached(self, firstSector, numSectors, numBytes):
+        start = firstSector * self.blockSize
+        end = start + numSectors * self.blockSize
+
+        if self.map is not None:
+            data = self.map
+        else:
+
+            # Read all sectors at once
+            self.file.seek(start)
+            data = self.file.read(end - start)
+            end -= start
+            start = 0
+
+        if self.blockSize == 2048:
+            return data[start:start + numBytes]
+
+        # Raw image, gather the user data of all sectors
+        pieces = [data[offset:offset + 2048] for offset in xrange(start + self.blockOffset, end, self.blockSize)]
+        pieces[-1] = pieces[-1][:numBytes - (numSectors - 1) * 2048]
+        return "".join(pieces)
+
+    # Discard all cached sectors.
+    def clearCache(self):
+        self.cache.clear()
+
+    # Read contiguous data from the image given the start sector and number
+    # of bytes to read. Returns the data as a read-only buffer object, which
+    # for memory-mapped 2048-byte-per-sector images refers directly to the
+    # image data without copying it.
+    def readExtentView(self, firstSector, numBytes):
+        if self.map is not None and self.blockSize == 2048 and numBytes > 0:
+            numSectors = (numBytes + 2047) / 2048
+            self.checkSectors(firstSector, numSectors)
+
+            return buffer(self.map, firstSector * 2048, numBytes)
+
+        return buffer(self.readExtent(firstSector, numBytes))
+
+    # Discard the cached directory index. This must be called when the file
+    # system of the image has been modified.
+    def invalidateIndex(self):
+
+        # Maps full path names to (firstSector, numBytes, flags) tuples,
+        # filled in lazily as directories are parsed
+        self.index = {"": (self.rootDirSector, self.rootDirSize, 0x02)}
+
+        # Path names of directories which have been parsed
+        self.parsedDirs = set()
+
+        # Maps full path names to the (sector, offset) location of their
+        # directory records
+        self.records = {}
+
+    # Parse the directory with the given path name and add its entries to
+    # the index.
+    def parseDirectory(self, dirPath):
+        dirSector, dirSize, flags = self.index[dirPath]
+        dir = self.readExtentView(dirSector, dirSize)
+
+        if dirPath:
+            prefix = dirPath + '/'
+        else:
+            prefix = ""
+
+        offset = 0
+        while offset < dirSize:
+
+            # Get record length and type
+            recLen = ord(dir[offset])
+            if recLen == 0:
+                offset += 1  # empty padding at end of sector
+                continue
+
+            recType = ord(dir[offset + 0x19])
+
+            # Get entry name
+            nameLen = ord(dir[offset + 0x20])
+            name = dir[offset + 0x21:offset + 0x21 + nameLen]
+            name = name.split(';')[0]  # strip file version numbers
+
+            # Skip the "." and ".." entries, for duplicate names the first
+            # entry wins
+            path = prefix + name
+            if name not in ("\x00", "\x01") and path not in self.index:
+                firstSector, numBytes = struct.unpack_from("<L4xL", dir, offset + 2)
+                self.index[path] = (firstSector, numBytes, recType)
+                self.records[path] = (dirSector + offset / 2048, offset % 2048)
+
+            # Move to next record
+            offset += recLen
+
+        self.parsedDirs.add(dirPath)
+
+    # Find a file or directory in the image by path name, returning a
+    # (firstSector, numBytes, flags) tuple. Raises a KeyError if the file
+    # or directory was not found.
+    def findEntry(self, pathName):
+        pathName = pathName.lstrip('/')
+
+        try:
+            return self.index[pathName]
+        except KeyError:
+            pass
+
+        # Parse all directories along the path which have not been
+        # parsed yet
+        path = pathName.split('/')
+        dirPath = ""
+
+        for i in xrange(len(path)):
+            if dirPath not in self.parsedDirs:
+                entry = self.index.get(dirPath)
+
+                if (entry is None) or (entry[2] & 0x02) == 0:
+
+                    # Directory not found, or expected a directory but
+                    # found a file
+                    raise KeyError, "'%s' not found in disc image" % pathName
+
+                self.parseDirectory(dirPath)
+
+            dirPath = '/'.join(path[:i + 1])
+
+        try:
+            return self.index[pathName]
+        except KeyError:
+            raise KeyError, "'%s' not found in disc image" % pathName
 
     # Find a file or directory in the image by path name, returning a
     # (firstSector, numBytes) tuple. Raises a KeyError if the file or
     # directory was not found.
     def findExtent(self, pathName):
+        return self.findEntry(pathName)[:2]
+
+    # Write 2048-byte sectors of user data to the image, starting at the
+    # given sector. For raw images, the sector headers and EDC/ECC are
+    # regenerated. If 'subHeader' is given it is used as the sub-header of
+    # all but the last written sector, and 'lastSubHeader' for the last
+    # one; otherwise the existing sub-headers are preserved.
+    def writeSectors(self, firstSector, data, subHeader = None, lastSubHeader = None):
+        numSectors = len(data) / 2048
+        self.checkSectors(firstSector, numSectors)
+
+        if self.blockSize == 2048:
+            blocks = data
+        else:
+            blocks = bytearray(numSectors * RAW_SECTOR_SIZE)
 
-        # Split the path into components
-        path = pathName.lstrip('/').split('/')
+            for i in xrange(numSectors):
+                sectorNr = firstSector + i
+                offset = i * RAW_SECTOR_SIZE
 
-        # Start the search at the root directory
-        dirSector = self.rootDirSector
-        dirSize = self.rootDirSize
+                # Sync pattern and header with address in MSF format
+                blocks[offset:offset + 12] = SYNC_PATTERN
 
-        # Search iteratively along the path
-        while len(path) > 0:
+                m, s = divmod(sectorNr + 150, 75 * 60)
+                s, f = divmod(s, 75)
+                blocks[offset + 12:offset + 16] = chr(_bcd(m)) + chr(_bcd(s)) + chr(_bcd(f)) + "\x02"
 
-            # Read the directory
-            dir = self.readExtent(dirSector, dirSize)
+                # Sub-header
+                if subHeader is None:
+                    blocks[offset + 16:offset + 24] = self.readBlocks(sectorNr, 1)[16:24]
+                elif i == numSectors - 1:
+                    blocks[offset + 16:offset + 24] = lastSubHeader
+                else:
+                    blocks[offset + 16:offset + 24] = subHeader
 
-            # Search directory records for the next component in the path
-            firstSector = None
-            numBytes = None
+                # User data
+                blocks[offset + 24:offset + 2072] = data[i * 2048:(i + 1) * 2048]
 
-            offset = 0
-            while (firstSector is None) and (offset < dirSize):
+            # Calculate the EDC and ECC
+            blocks = encodeRawSectors(blocks)
 
-                # Get record length and type
-                recLen = ord(dir[offset])
-                if recLen == 0:
-                    offset += 1  # empty padding at end of sector
-                    continue
+        self.writeBlocks(firstSector, blocks)
 
-                recType = ord(dir[offset + 0x19])
+    # Write complete blocks to the image, starting at block 'firstBlock'.
+    def writeBlocks(self, firstBlock, data):
+        start = firstBlock * self.blockSize
 
-                # Compare entry name
-                nameLen = ord(dir[offset + 0x20])
-                name = dir[offset + 0x21:offset + 0x21 + nameLen]
-                name = name.split(';')[0]  # strip file version numbers
+        for sector in xrange(firstBlock, firstBlock + len(data) / self.blockSize):
+            self.cache.pop(sector, None)
 
-                if name == path[0]:
+        if self.map is not None:
+            self.map[start:start + len(data)] = data
+        else:
+            self.file.seek(start)
+            self.file.write(data)
 
-                    # Found it
-                    firstSector, numBytes = struct.unpack_from("<L4xL", dir, offset + 2)
+    # Check the EDC and ECC of the given range of sectors (by default, the
+    # entire image). Returns a list of the numbers of the bad sectors. Only
+    # raw images contain error correction data, so for other images the
+    # list is always empty.
+    def verify(self, firstSector = 0, numSectors = None):
+        if numSectors is None:
+            numSectors = self.numSectors - firstSector
 
-                    if (len(path) > 1) and (recType & 0x02) == 0:
+        self.checkSectors(firstSector, numSectors)
 
-                        # Expected a directory but found a file
-                        raise KeyError, "'%s' not found in disc image" % pathName
+        badSectors = []
+        if self.blockSize == RAW_SECTOR_SIZE:
+            for sector in xrange(firstSector, firstSector + numSectors, self.batchSize):
+                count = min(self.batchSize, firstSector + numSectors - sector)
+                badSectors += [sector + i for i in verifyRawSectors(self.readBlocks(sector, count))]
 
-                # Move to next record
-                offset += recLen
+        return badSectors
 
-            if firstSector is None:
-                raise KeyError, "'%s' not found in disc image" % pathName
+    # Regenerate the EDC and ECC of the given range of sectors (by default,
+    # the entire image).
+    def resign(self, firstSector = 0, numSectors = None):
+        if not self.writable:
+            raise EnvironmentError, "Disc image not opened for writing"
 
-            if len(path) == 1:
+        if numSectors is None:
+            numSectors = self.numSectors - firstSector
 
-                # Found the file or directory
-                return (firstSector, numBytes)
+        self.checkSectors(firstSector, numSectors)
 
-            else:
+        if self.blockSize == RAW_SECTOR_SIZE:
+            for sector in xrange(firstSector, firstSector + numSectors, self.batchSize):
+                count = min(self.batchSize, firstSector + numSectors - sector)
+                self.writeBlocks(sector, encodeRawSectors(self.readBlocks(sector, count)))
+
+    # Replace the contents of a file in the image specified by path name.
+    # The new data is written in place, so it must fit into the sectors
+    # occupied by the original file. The size stored in the directory
+    # record is updated. Raises a KeyError if the file was not found.
+    def writeFile(self, pathName, data):
+        if not self.writable:
+            raise EnvironmentError, "Disc image not opened for writing"
+
+        pathName = pathName.lstrip('/')
+        firstSector, numBytes, flags = self.findEntry(pathName)
+
+        if flags & 0x02:
+            raise EnvironmentError, "'%s' is a directory" % pathName
+
+        numSectors = (numBytes + 2047) / 2048
+        newNumSectors = (len(data) + 2047) / 2048
+
+        if newNumSectors > numSectors:
+            raise EnvironmentError, "'%s' is too large to be written in place (%d bytes, max. %d bytes)" % (pathName, len(data), numSectors * 2048)
+
+        # Write the file data, padded to a multiple of the sector size
+        size = len(data)
+        if size % 2048:
+            data += "\0" * (2048 - size % 2048)
 
-                # Descend to subdirectory and continue
-                dirSector = firstSector
-                dirSize = numBytes
-                path.pop(0)
+        if data:
+            self.writeSectors(firstSector, data, "\0\0\x08\0\0\0\x08\0", "\0\0\x89\0\0\0\x89\0")
+
+        # Update the file size in the directory record, which is stored in
+        # both little- and big-endian byte order
+        recSector, recOffset = self.records[pathName]
+
+        dirData = bytearray(self.readExtent(recSector, 2048))
+        struct.pack_into("<L", dirData, recOffset + 10, size)
+        struct.pack_into(">L", dirData, recOffset + 14, size)
+        self.writeSectors(recSector, str(dirData))
+
+        self.index[pathName] = (firstSector, size, flags)
 
     # Read a file from the image specified by path name, returning the file
     # data as a byte string. Raises a KeyError if the file was not found.
     def readFile(self, pathName):
         firstSector, numBytes = self.findExtent(pathName)
         return self.readExtent(firstSector, numBytes)
+
+    # Open a file in the image specified by path name, returning a read-only
+    # file object. Raises a KeyError if the file was not found.
+    def openFile(self, pathName):
+        firstSector, numBytes = self.findExtent(pathName)
+        return ImageFile(self, firstSector, numBytes, pathName)
+
+
+# Read-only file object for a file in a disc image. The file data is read
+# from the image on demand, a few sectors at a time.
+class ImageFile:
+
+    # Number of sectors read ahead for small reads
+    readAheadSectors = 8
+
+    # Create a file object for the extent at 'firstSector' with a size of
+    # 'size' bytes in the Image 'image'. The 'name' is used as the file
+    # name.
+    def __init__(self, image, firstSector, size, name):
+        self.image = image
+        self.firstSector = firstSector
+        self.size = size
+        self.name = name
+
+        self.pos = 0            # Current file position
+        self.cacheStart = 0     # File position of cached data
+        self.cacheData = ""     # Cached data
+        self.closed = False
+
+    # Read data from the file, starting at a sector boundary.
+    def readSectors(self, start, numBytes):
+        numBytes = min(numBytes, self.size - start)
+        return self.image.readExtent(self.firstSector + start / 2048, numBytes)
+
+    # Make sure that the cache contains the data at the current position.
+    # Returns False at the end of the file.
+    def fillCache(self):
+        if self.cacheStart <= self.pos < self.cacheStart + len(self.cacheData):
+            return True
+
+        if self.pos >= self.size:
+            return False
+
+        self.cacheStart = self.pos - self.pos % 2048
+        self.cacheData = self.readSectors(self.cacheStart, self.readAheadSectors * 2048)
+        return True
+
+    # Read up to 'size' bytes from the file, or everything up to the end of
+    # the file if 'size' is negative.
+    def read(self, size = -1):
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+
+        end = self.size
+        if size >= 0:
+            end = min(self.pos + size, end)
+
+        if end <= self.pos:
+            return ""
+
+        if end - self.pos > self.readAheadSectors * 2048:
+
+            # Large read, bypass the cache
+            start = self.pos - self.pos % 2048
+            data = self.readSectors(start, end - start)[self.pos - start:]
+
+        else:
+            pieces = []
+            while self.pos < end:
+                self.fillCache()
+
+                offset = self.pos - self.cacheStart
+                piece = self.cacheData[offset:offset + end - self.pos]
+
+                pieces.append(piece)
+                self.pos += len(piece)
+
+            data = "".join(pieces)
+
+        self.pos = end
+        return data
+
+    # Read one line from the file, including the trailing newline.
+    def readline(self, size = -1):
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+
+        line = ""
+        while self.fillCache():
+            offset = self.pos - self.cacheStart
+
+            end = self.cacheData.find("\n", offset)
+            if end < 0:
+                end = len(self.cacheData)
+            else:
+                end += 1
+
+            if size >= 0:
+                end = min(end, offset + size - len(line))
+
+            line += self.cacheData[offset:end]
+            self.pos = self.cacheStart + end
+
+            if line.endswith("\n") or len(line) == size:
+                break
+
+        return line
+
+    # Set the file position.
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        if offset < 0:
+            raise IOError, "Invalid file position"
+
+        self.pos = offset
+
+    # Return the file position.
+    def tell(self):
+        return self.pos
+
+    # Close the file. The underlying image stays open.
+    def close(self):
+        self.cacheData = ""
+        self.closed = True
@@ -10,10 +10,19 @@
 # copyright notice and this permission notice appear in all copies.
 #
 
+import codecs
+import collections
 import re
 import struct
 
 
+# NumPy is optional, it speeds up measuring many strings at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 # Characters in range 0x00..0xdf directly map to Unicode characters.
 # This is almost identical to the MacOS Roman encoding shifted down
 # by 32 positions.
@@ -205,106 +214,173 @@ fieldCommands.update({v:('\xfe' + k) for k, v in fieldControlCodes.iteritems()})
 escapeChars = u"\\{}"
 
 
-# Decode FF7 field text string to unicode string.
-def decodeField(data, japanese = False):
-    if japanese:
-        charset = normalCharsJP
-        numNormalChars = '\xe7'
-    else:
-        charset = normalChars
-        numNormalChars = '\xe0'
+# A decoder consists of a character map, a pattern matching runs of bytes
+# covered by the map, and a table for all other bytes. The character map
+# assigns the final (already escaped) output string to each byte with a fixed
+# translation, which includes regular printable characters as well as
+# single-byte commands. Such runs are decoded in bulk. The table maps each
+# remaining byte to a handler function which is called with the data and the
+# offset following the byte, and returns the output string and the new
+# offset. A table entry of None terminates the string.
 
-    dataSize = len(data)
-    text = u""
+# Raised by decoder handlers when a string ends in the middle of a multi-byte
+# code
+class _TruncatedError(IndexError):
+    pass
 
-    i = 0
-    while i < dataSize:
-        c = data[i]
-        i += 1
+# Build the character map for regular printable characters in range
+# 0x00..numNormalChars-1.
+def _makeCharmap(charset, numNormalChars):
+    charmap = {}
 
-        if c == '\xff':
+    for code in xrange(numNormalChars):
+        t = charset[code]
 
-            # End of string
-            break
+        if t in escapeChars:
+            t = u"\\" + t
 
-        elif c < numNormalChars:
+        charmap[code] = t
 
-            # Regular printable character
-            t = charset[ord(c)]
+    return charmap
 
-            if t in escapeChars:
-                text += u"\\"
+# Assemble a decoder from a character map and a handler table.
+def _makeDecoder(charmap, table):
+    runChars = "".join("\\x%02x" % code for code in sorted(charmap))
+    return charmap, re.compile("[%s]*" % runChars), table
 
-            text += t
+# Return a handler for two-byte kanji codes.
+def _makeKanjiHandler(kanjiSet, spuriousMessage, stringType):
+    kanji = [kanjiSet[code] if code < len(kanjiSet) else None for code in xrange(256)]
 
-        elif c >= '\xfa' and c <= '\xfd' and japanese:
+    def handler(data, i):
+        if i >= len(data):
+            raise _TruncatedError, spuriousMessage % (ord(data[i - 1]), data)
 
-            # Kanji
-            if i >= dataSize:
-                raise IndexError, "Spurious kanji code %02x at end of string %r" % (ord(c), data)
+        t = kanji[ord(data[i])]
+        if t is None:
+            raise IndexError, "Invalid kanji code %02x %02x in %s %r" % (ord(data[i - 1]), ord(data[i]), stringType, data)
 
-            k = data[i]
-            i += 1
+        return t, i + 1
+
+    return handler
+
+# Return a handler for codes which are illegal in a string.
+def _makeIllegalHandler(message):
+    def handler(data, i):
+        raise IndexError, message % (ord(data[i - 1]), data)
 
-            text += decodeKanji(c, ord(k))
+    return handler
+
+# Decode a string using the specified character map, run pattern, and
+# decoder table.
+def _decode(data, charmap, runs, table):
+    dataSize = len(data)
+    text = []
+
+    i = 0
+    while i < dataSize:
 
-        elif c == '\xfe':
+        # Run of characters with a fixed translation
+        j = runs.match(data, i).end()
+        if j > i:
+            text.append(codecs.charmap_decode(data[i:j], "strict", charmap)[0])
+            i = j
 
-            # Field module control code or kanji
             if i >= dataSize:
-                raise IndexError, "Spurious control code %02x at end of string %r" % (ord(c), data)
+                break
 
-            k = data[i]
-            i += 1
+        # Control code
+        t = table[ord(data[i])]
+        if t is None:
+
+            # End of string
+            break
 
-            if k < '\xd2' and japanese:
+        t, i = t(data, i + 1)
+        text.append(t)
 
-                text += decodeKanji(c, ord(k))
+    return u"".join(text)
 
-            elif k == '\xdd':
 
-                # WAIT <arg> command
-                if i >= dataSize - 1:
-                    raise IndexError, "Spurious WAIT command at end of string %r" % data
+# WAIT <arg> command of the field module
+def _decodeFieldWait(data, i):
+    if i >= len(data) - 1:
+        raise _TruncatedError, "Spurious WAIT command at end of string %r" % data
 
-                arg = struct.unpack_from("<H", data, i)
-                i += 2
+    arg = struct.unpack_from("<H", data, i)
+    return u"{WAIT %d}" % arg, i + 2
 
-                text += u"{WAIT %d}" % arg
+# STR <offset> <length> command of the field module
+def _decodeFieldStr(data, i):
+    if i >= len(data) - 3:
+        raise _TruncatedError, "Spurious STR command at end of string %r" % data
 
-            elif k == '\xe2':
+    offset, length = struct.unpack_from("<HH", data, i)
+    return u"{STR %04x %04x}" % (offset, length), i + 4
 
-                # STR <offset> <length> command
-                if i >= dataSize - 3:
-                    raise IndexError, "Spurious STR command at end of string %r" % data
+# Return a handler for extended control codes (0xfe ..) of the field module.
+def _makeFieldControlHandler(japanese):
+    controls = [None] * 256
 
-                offset, length = struct.unpack_from("<HH", data, i)
-                i += 4
+    if japanese:
+        for code, t in enumerate(kanjiSet5[:0xd2]):
+            controls[code] = t
 
-                text += u"{STR %04x %04x}" % (offset, length)
+    for k, t in fieldControlCodes.iteritems():
+        controls[ord(k)] = t
 
-            else:
+    controls[0xdd] = _decodeFieldWait
+    controls[0xe2] = _decodeFieldStr
 
-                # Other control code
-                if not k in fieldControlCodes:
-                    raise IndexError, "Illegal control code %02x in field string %r" % (ord(k), data)
+    def handler(data, i):
+        if i >= len(data):
+            raise _TruncatedError, "Spurious control code %02x at end of string %r" % (ord(data[i - 1]), data)
 
-                text += fieldControlCodes[k]
-                
+        t = controls[ord(data[i])]
+        if t is None:
+            raise IndexError, "Illegal control code %02x in field string %r" % (ord(data[i]), data)
+        elif isinstance(t, unicode):
+            return t, i + 1
         else:
+            return t(data, i + 1)
 
-            # Field module special character
-            t = fieldSpecialChars[c]
+    return handler
 
-            if not t:
-                raise IndexError, "Illegal character %02x in field string %r" % (ord(c), data)
+# Build the decoder for field strings.
+def _makeFieldDecoder(japanese):
+    if japanese:
+        charmap = _makeCharmap(normalCharsJP, 0xe7)
+    else:
+        charmap = _makeCharmap(normalChars, 0xe0)
+
+    for code in xrange(0xe0, 0xfe):
+        t = fieldSpecialChars.get(chr(code))
+        if t and code not in charmap:
+            if code == 0xe8:  # newline after {NEW}
+                t += u"\n"
+            charmap[code] = t
 
-            if c == '\xe8':  # newline after {NEW}
-                t += '\n'
+    table = [_makeIllegalHandler("Illegal character %02x in field string %r")] * 256
+
+    if japanese:
+        for code, kanjiSet in zip(range(0xfa, 0xfe), (kanjiSet1, kanjiSet2, kanjiSet3, kanjiSet4)):
+            table[code] = _makeKanjiHandler(kanjiSet, "Spurious kanji code %02x at end of string %r", "field string")
 
-            text += t
+    table[0xfe] = _makeFieldControlHandler(japanese)
+    table[0xff] = None
 
-    return text
+    return _makeDecoder(charmap, table)
+
+fieldDecoder = _makeFieldDecoder(False)
+fieldDecoderJP = _makeFieldDecoder(True)
+
+
+# Decode FF7 field text string to unicode string.
+def decodeField(data, japanese = False):
+    if japanese:
+        return _decode(data, *fieldDecoderJP)
+    else:
+        return _decode(data, *fieldDecoder)
 
 
 # Control codes referencing kernel variables
@@ -319,70 +395,92 @@ kernelVars = {
 }
 
 
-# Decode FF7 kernel text string to unicode string.
-def decodeKernel(data, japanese = False):
-    if japanese:
-        charset = normalCharsJP
-    else:
-        charset = normalChars
+# Kernel variable reference
+def _makeKernelVarHandler(keyword):
+    def handler(data, i):
+        if i >= len(data) - 1:
+            raise _TruncatedError, "Spurious control code %02x at end of kernel string %r" % (ord(data[i - 1]), data)
 
-    dataSize = len(data)
-    text = u""
+        return u"{%s %02x %02x}" % (keyword, ord(data[i]), ord(data[i + 1])), i + 2
 
-    i = 0
-    while i < dataSize:
-        c = data[i]
-        i += 1
+    return handler
 
-        if c == '\xff':
+# Text box color
+def _decodeKernelColor(data, i):
+    if i >= len(data):
+        raise _TruncatedError, "Spurious color code at end of kernel string %r" % data
 
-            # End of string
-            break
+    return u"{COLOR %02x}" % ord(data[i]), i + 1
 
-        elif c < '\xe7':
+# Build the decoder for kernel strings.
+def _makeKernelDecoder(japanese):
+    if japanese:
+        charmap = _makeCharmap(normalCharsJP, 0xe7)
+    else:
+        charmap = _makeCharmap(normalChars, 0xe7)
 
-            # Regular printable character
-            t = charset[ord(c)]
+    table = [_makeIllegalHandler("Illegal control code %02x in kernel string %r")] * 256
 
-            if t in escapeChars:
-                text += u"\\"
+    for k, keyword in kernelVars.iteritems():
+        table[ord(k)] = _makeKernelVarHandler(keyword)
 
-            text += t
+    table[0xf8] = _decodeKernelColor
 
-        elif c >= '\xea' and c <= '\xf0':
+    if japanese:
+        for code, kanjiSet in zip(range(0xfa, 0xff), (kanjiSet1, kanjiSet2, kanjiSet3, kanjiSet4, kanjiSet5)):
+            table[code] = _makeKanjiHandler(kanjiSet, "Spurious kanji code %02x at end of kernel string %r", "kernel string")
 
-            # Kernel variable
-            if i >= dataSize - 1:
-                raise IndexError, "Spurious control code %02x at end of kernel string %r" % (ord(c), data)
+    table[0xff] = None
 
-            text += u"{%s %02x %02x}" % (kernelVars[c], ord(data[i]), ord(data[i+1]))
-            i += 2
+    return _makeDecoder(charmap, table)
 
-        elif c == '\xf8':
+kernelDecoder = _makeKernelDecoder(False)
+kernelDecoderJP = _makeKernelDecoder(True)
 
-            # Text box color
-            if i >= dataSize:
-                raise IndexError, "Spurious color code at end of kernel string %r" % data
 
-            text += u"{COLOR %02x}" % ord(data[i])
-            i += 1
+# Decode FF7 kernel text string to unicode string.
+def decodeKernel(data, japanese = False):
+    if japanese:
+        return _decode(data, *kernelDecoderJP)
+    else:
+        return _decode(data, *kernelDecoder)
 
-        elif c >= '\xfa' and c <= '\xfe' and japanese:
 
-            # Kanji
-            if i >= dataSize:
-                raise IndexError, "Spurious kanji code %02x at end of kernel string %r" % (ord(c), data)
+# Tokenizer for text strings, matching either a run of literal characters,
+# an escape sequence, or a command sequence
+_tokenPattern = re.compile(ur"([^\\{]+)|\\(.?)|\{([^}]*)(\}?)", re.DOTALL)
 
-            k = data[i]
-            i += 1
+# Argument patterns of commands
+_waitPattern = re.compile(r"WAIT (\d+)")
+_strPattern = re.compile(r"STR ([a-fA-F0-9]{4}) ([a-fA-F0-9]{4})")
+_colorPattern = re.compile(r"COLOR ([a-fA-F0-9]{2})")
+_kernelVarPatterns = {keyword: (code, re.compile(r"%s ([a-fA-F0-9]{2}) ([a-fA-F0-9]{2})" % keyword)) for code, keyword in kernelVars.iteritems()}
 
-            text += decodeKanji(c, ord(k))
+# Build the mapping of characters to codes for encoding literal text. If a
+# character appears multiple times, the first occurrence is used.
+def _makeEncodingMap(field, japanese):
+    encodingMap = {}
 
-        else:
+    if field:
+        for c, code in ((u"\t", '\xe1'), (u"\n", '\xe7'), (u"〇", '\xf6'), (u"△", '\xf7'), (u"☐", '\xf8'), (u"✕", '\xf9')):
+            encodingMap[ord(c)] = code
 
-            raise IndexError, "Illegal control code %02x in kernel string %r" % (ord(c), data)
+    if japanese:
+        charset = normalCharsJP
+    else:
+        charset = normalChars
+
+    for code, c in enumerate(charset):
+        encodingMap.setdefault(ord(c), chr(code))
+
+    if japanese:
+        for bank, kanjiSet in zip("\xfa\xfb\xfc\xfd\xfe", (kanjiSet1, kanjiSet2, kanjiSet3, kanjiSet4, kanjiSet5)):
+            for code, c in enumerate(kanjiSet):
+                encodingMap.setdefault(ord(c), bank + chr(code))
+
+    return encodingMap
 
-    return text
+_encodingMaps = {(field, japanese): _makeEncodingMap(field, japanese) for field in (False, True) for japanese in (False, True)}
 
 
 # Encode unicode string to FF7 text string.
@@ -392,38 +490,46 @@ def encode(text, field, japanese):
     else:
         charset = normalChars
 
+    encodingMap = _encodingMaps[(field, japanese)]
+
     textSize = len(text)
-    data = ""
+    data = bytearray()
 
     i = 0
     while i < textSize:
-        c = text[i]
-        i += 1
+        m = _tokenPattern.match(text, i)
+        i = m.end()
+
+        literal, escape, command, closing = m.groups()
+
+        if literal is not None:
+
+            # Run of literal characters
+            try:
+                data += codecs.charmap_encode(literal, "strict", encodingMap)[0]
+            except UnicodeEncodeError as e:
+                raise ValueError, "Unencodable character '%s' in string '%s'" % (literal[e.start], text)
 
-        if c == u'\\':
+        elif escape is not None:
 
             # Escape sequence
-            if i >= textSize:
+            if not escape:
                 raise IndexError, "Spurious '\\' at end of string '%s'" % text
 
-            c = text[i]
-            i += 1
-
-            if c in escapeChars:
-                data += chr(charset.index(c))
+            if escape in escapeChars and escape in charset:
+                data.append(charset.index(escape))
+            elif escape in escapeChars:
+                raise ValueError, "Unencodable character '%s' in string '%s'" % (escape, text)
             else:
-                raise ValueError, "Unknown escape sequence '\\%s' in string '%s'" % (c, text)
+                raise ValueError, "Unknown escape sequence '\\%s' in string '%s'" % (escape, text)
 
-        elif c == u'{':
+        else:
 
             # Command sequence
-            end = text.find(u'}', i)
-            if end == -1:
+            if not closing:
                 raise IndexError, "Mismatched {} in string '%s'" % text
 
-            command = text[i:end]
             keyword = command.split()[0]
-            i = end + 1
 
             if field:
 
@@ -431,7 +537,7 @@ def encode(text, field, japanese):
                 if keyword == u'WAIT':
 
                     # WAIT <arg>
-                    m = re.match(r"WAIT (\d+)", command)
+                    m = _waitPattern.match(command)
                     if not m:
                         raise ValueError, "Syntax error in command '%s' in string '%s'" % (command, text)
 
@@ -445,7 +551,7 @@ def encode(text, field, japanese):
                 elif keyword == u'STR':
 
                     # STR <offset> <length>
-                    m = re.match(r"STR ([a-fA-F0-9]{4}) ([a-fA-F0-9]{4})", command)
+                    m = _strPattern.match(command)
                     if not m:
                         raise ValueError, "Syntax error in command '%s' in string '%s'" % (command, text)
 
@@ -459,95 +565,114 @@ def encode(text, field, japanese):
 
                     # Simple command without arguments
                     try:
-                        code = fieldCommands['{' + command + '}']
-                        data += code
-
-                        # Strip extra newline after NEW command
-                        if command == "NEW":
-                            if (i < textSize) and (text[i] == u'\n'):
-                                i += 1
-
+                        data += fieldCommands['{' + command + '}']
                     except KeyError:
                         raise ValueError, "Unknown command '%s' in string '%s'" % (command, text)
 
+                    # Strip extra newline after NEW command
+                    if command == "NEW":
+                        if (i < textSize) and (text[i] == u'\n'):
+                            i += 1
+
             else:
 
                 # Kernel command
                 if keyword == u'COLOR':
 
                     # Text box color
-                    m = re.match(r"COLOR ([a-fA-F0-9]{2})", command)
+                    m = _colorPattern.match(command)
                     if not m:
                         raise ValueError, "Syntax error in command '%s' in string '%s'" % (command, text)
 
-                    data += '\xf8'
-                    data += chr(int(m.group(1), 16))
+                    data.append('\xf8')
+                    data.append(int(m.group(1), 16))
 
                 else:
 
                     # Kernel variable reference
-                    found = False
-                    for (code, checkKeyword,) in kernelVars.iteritems():
-                        if keyword == checkKeyword:
-                            m = re.match(r"%s ([a-fA-F0-9]{2}) ([a-fA-F0-9]{2})" % keyword, command)
-                            if not m:
-                                raise ValueError, "Syntax error in command '%s' in string '%s'" % (command, text)
+                    try:
+                        code, pattern = _kernelVarPatterns[keyword]
+                    except KeyError:
+                        raise ValueError, "Unknown command '%s' in string '%s'" % (command, text)
 
-                            data += code
-                            data += chr(int(m.group(1), 16))
-                            data += chr(int(m.group(2), 16))
+                    m = pattern.match(command)
+                    if not m:
+                        raise ValueError, "Syntax error in command '%s' in string '%s'" % (command, text)
 
-                            found = True
-                            break
+                    data += code
+                    data.append(int(m.group(1), 16))
+                    data.append(int(m.group(2), 16))
 
-                    if not found:
-                        raise ValueError, "Unknown command '%s' in string '%s'" % (command, text)
+    # Terminate string
+    data.append('\xff')
+    return str(data)
 
-        else:
 
-            # Handle special field characters
-            if field:
-                if c == u'\t':
-                    data += '\xe1'
-                    continue
-                elif c == u'\n':
-                    data += '\xe7'
-                    continue
-                elif c == u'〇':
-                    data += '\xf6'
-                    continue
-                elif c == u'△':
-                    data += '\xf7'
-                    continue
-                elif c == u'☐':
-                    data += '\xf8'
-                    continue
-                elif c == u'✕':
-                    data += '\xf9'
-                    continue
-# TODO: Disabled for now since these shortcuts don't work in map names and
-# are not particularly useful to begin with...
-#                elif c == u',' and i < textSize and text[i] == u' ':
-#                    data += '\xe2'
-#                    i += 1
-#                    continue
-#                elif c == u'.' and i < textSize and text[i] == u'"':
-#                    data += '\xe3'
-#                    i += 1
-#                    continue
-#                elif c == u'…' and i < textSize and text[i] == u'"':
-#                    data += '\xe4'
-#                    i += 1
-#                    continue
-
-            # Regular printable character
-            try:
-                data += chr(charset.index(c))
-            except ValueError:
-                raise ValueError, "Unencodable character '%s' in string '%s'" % (c, text)
+# LRU memo of encoded and decoded strings. Many strings, such as character
+# names, choices, and shop texts, appear in more than one field map or
+# scene, so the batch functions below avoid converting them repeatedly.
+class _Memo:
+
+    def __init__(self, size):
+        self.size = size           # Maximum number of entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0              # Number of strings found in the memo
+        self.misses = 0            # Number of strings converted
+
+    # Convert a list of items with the given function, looking up and
+    # storing the results under the key (item, variant).
+    def convert(self, func, items, variant):
+        entries = self.entries
+        results = []
+
+        for item in items:
+            key = (item, variant)
+            result = entries.pop(key, None)
+
+            if result is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                result = func(item)
+
+            # Move entry to the end of the LRU list
+            entries[key] = result
+            results.append(result)
+
+        # Evict the least recently used entries
+        while len(entries) > self.size:
+            entries.popitem(last = False)
+
+        return results
+
+_memo = _Memo(4096)
+
+
+# Decode a list of FF7 text strings to a list of unicode strings.
+def decodeMany(dataList, field, japanese = False):
+    if field:
+        decoder = fieldDecoderJP if japanese else fieldDecoder
+    else:
+        decoder = kernelDecoderJP if japanese else kernelDecoder
+
+    return _memo.convert(lambda data: _decode(data, *decoder), dataList, ("decode", field, japanese))
+
+
+# Encode a list of unicode strings to a list of FF7 text strings.
+def encodeMany(texts, field, japanese = False):
+    return _memo.convert(lambda text: encode(text, field, japanese), texts, ("encode", field, japanese))
 
-    # Terminate string
-    return data + '\xff'
+
+# Return the statistics of the string memo as a (hits, misses) tuple.
+def cacheStats():
+    return (_memo.hits, _memo.misses)
+
+
+# Clear the string memo and its statistics.
+def clearCache():
+    _memo.entries.clear()
+    _memo.hits = 0
+    _memo.misses = 0
 
 
 # Return the pixel width of a character.
@@ -560,127 +685,338 @@ def charWidth(c, fixed, metrics):
 
 
 # Determine the maximum pixel width and height required for displaying a field
-# text string, returning a (width, height) tuple. The 'metrics' argument is an
-# array of character width/kerning data, as found in the WINDOW.BIN archive.
+# text string, returning a (width, height) tuple. The 'metrics' argument is
+# either a TextMetrics object, or an array of character width/kerning data, as
+# found in the WINDOW.BIN archive.
 def extent(text, metrics):
+    if not isinstance(metrics, TextMetrics):
+        metrics = TextMetrics(metrics)
+
+    return metrics.extent(text)
+
+
+# Pattern splitting encoded field text into runs of characters which have a
+# fixed width, followed by a line break, page break, or extended control code
+# with its arguments
+_extentPattern = re.compile(r"([^\xe7\xe8\xfe]*)(\xe7|\xe8|\xfe\xdd.{0,2}|\xfe\xe2.{0,4}|\xfe.?|)", re.DOTALL)
+
+
+# Text extent calculation for a given set of font metrics. The width tables
+# are precomputed for normal and fixed-width character spacing.
+class TextMetrics:
+
     maxCharacterNameLen = 9
     lineHeight = 16
+    maxLines = 13
 
-    data = encode(text, True, False)
-    dataSize = len(data)
+    # Create the width tables from an array of character width/kerning data,
+    # as found in the WINDOW.BIN archive.
+    def __init__(self, metrics):
+        self.widths = self._makeWidthTable([charWidth(c, False, metrics) for c in xrange(0xe0)])
+        self.fixedWidths = self._makeWidthTable([charWidth(c, True, metrics) for c in xrange(0xe0)])
 
-    maxWidth = 0
-    maxLines = 0
+    # Return a table of the widths of all field text codes, given the widths
+    # of the regular characters.
+    def _makeWidthTable(self, charWidths):
+        table = charWidths + [0] * 0x20
 
-    lineWidth = 0
-    numLines = 1
+        table[0xe0] = charWidths[0] * 10                  # 10 spaces
+        table[0xe1] = charWidths[0] * 4                   # 4 spaces
+        table[0xe2] = charWidths[0x0c] + charWidths[0]    # ', ' shortcut
+        table[0xe3] = charWidths[0x0e] + charWidths[0x02] # '."' shortcut
+        table[0xe4] = charWidths[0xa9] + charWidths[0x02] # '…"' shortcut
 
-    fixed = False
+        # Character names, assume they're filled with 'W's
+        for c in xrange(0xea, 0xf6):
+            table[c] = charWidths[0x37] * self.maxCharacterNameLen
 
-    i = 0
-    while i < dataSize:
-        c = ord(data[i])
-        i += 1
+        # Controller buttons (estimated width)
+        for c in xrange(0xf6, 0xfa):
+            table[c] = 16
+
+        return table
+
+    # Determine the maximum pixel width and height required for displaying a
+    # field text string, returning a (width, height) tuple.
+    def extent(self, text):
+        return self.extentOfData(encodeMany([text], True)[0])
+
+    # Determine the maximum pixel width and height required for displaying an
+    # encoded (western) field text string, returning a (width, height) tuple.
+    def extentOfData(self, data):
+        widths = self.widths
+
+        maxWidth = 0
+        maxLines = 0
 
-        if c < 0xe0:
+        lineWidth = 0
+        numLines = 1
 
-            # Regular character
-            lineWidth += charWidth(c, fixed, metrics)
+        fixed = False
 
-        elif c == 0xe0:
+        for m in _extentPattern.finditer(data):
+            run, code = m.groups()
 
-            # 10 spaces
-            lineWidth += charWidth(0, fixed, metrics) * 10
+            if run:
+                lineWidth += sum(map(widths.__getitem__, bytearray(run)))
 
-        elif c == 0xe1:
+            if not code:
+                continue
 
-            # 4 spaces
-            lineWidth += charWidth(0, fixed, metrics) * 4
+            elif code == '\xe7':
 
-        elif c == 0xe2:
+                # New line
+                if lineWidth > maxWidth:
+                    maxWidth = lineWidth
+                lineWidth = 0
+                numLines += 1
 
-            # ', ' shortcut
-            lineWidth += charWidth(0x0c, fixed, metrics) + charWidth(0, fixed, metrics)
+            elif code == '\xe8':
+
+                # New page
+                if lineWidth > maxWidth:
+                    maxWidth = lineWidth
+                lineWidth = 0
+
+                if numLines > maxLines:
+                    maxLines = numLines
+                numLines = 1
+
+            elif len(code) < 2:
+                raise IndexError, "Spurious control code fe at end of string %r" % data
+
+            else:
 
-        elif c == 0xe3:
+                # Extended control code
+                c = code[1]
 
-            # '."' shortcut
-            lineWidth += charWidth(0x0e, fixed, metrics) + charWidth(0x02, fixed, metrics)
+                if c == '\xde' or c == '\xe1':
 
-        elif c == 0xe4:
+                    # Decimal variable, assume max. 5 digits (0..65535)
+                    lineWidth += widths[0x10] * 5  # '0'
 
-            # '…"'
-            lineWidth += charWidth(0xa9, fixed, metrics) + charWidth(0x02, fixed, metrics)
+                elif c == '\xdf':
 
-        elif c == 0xe7:
+                    # Hexadecimal variable, assume max. 4 digits (0..FFFF)
+                    lineWidth += widths[0x21] * 4  # 'A'
 
-            # New line
-            if lineWidth > maxWidth:
-                maxWidth = lineWidth
-            lineWidth = 0
-            numLines += 1
+                elif c == '\xe2':
 
-        elif c == 0xe8:
+                    # STR command, get length
+                    if len(code) < 6:
+                        raise IndexError, "Spurious STR command at end of string %r" % data
 
-            # New page
-            if lineWidth > maxWidth:
-                maxWidth = lineWidth
-            lineWidth = 0
+                    length = struct.unpack_from("<H", code, 4)[0]
+                    lineWidth += widths[0x37] * length  # 'W'
 
-            if numLines > maxLines:
-                maxLines = numLines
-            numLines = 1
+                elif c == '\xe9':
 
-        elif c >= 0xea and c <= 0xf5:
+                    # Toggle fixed-width character spacing
+                    fixed = not fixed
+                    widths = self.fixedWidths if fixed else self.widths
 
-            # Character name, assume it's filled with 'W's
-            lineWidth += charWidth(0x37, fixed, metrics) * maxCharacterNameLen
+        if lineWidth > maxWidth:
+            maxWidth = lineWidth
+        if numLines > maxLines:
+            maxLines = numLines
 
-        elif c >= 0xf6 and c <= 0xf9:
+        if maxLines > self.maxLines:
+            maxLines = self.maxLines
 
-            # Controller button (estimated width)
-            lineWidth += 16
+        return (maxWidth, maxLines * self.lineHeight)
 
-        elif c == 0xfe:
+    # Determine the extents of a list of encoded (western) field text
+    # strings, returning a list of (width, height) tuples. If NumPy is
+    # available, strings without extended control codes are measured
+    # together in one vectorized pass.
+    def extentMany(self, dataList):
+        if numpy is None:
+            return [self.extentOfData(data) for data in dataList]
 
-            # Extended control code
-            c = ord(data[i])
+        extents = [None] * len(dataList)
+
+        simple = []
+        for i, data in enumerate(dataList):
+            if data and '\xfe' not in data:
+                simple.append(i)
+            else:
+                extents[i] = self.extentOfData(data)
+
+        if not simple:
+            return extents
+
+        simpleData = [dataList[i] for i in simple]
+        codes = numpy.frombuffer("".join(simpleData), numpy.uint8)
+        widths = numpy.array(self.widths, numpy.int64)[codes]
+
+        # Start offsets of the strings
+        lengths = numpy.array([len(data) for data in simpleData])
+        starts = numpy.zeros(len(simpleData), numpy.int64)
+        starts[1:] = numpy.cumsum(lengths)[:-1]
+
+        # Number each line and page, a new one begins at the start of each
+        # string and after each line or page break
+        isNewLine = codes == 0xe7
+        isNewPage = codes == 0xe8
+
+        lineStarts = numpy.zeros(len(codes), numpy.int64)
+        lineStarts[1:] = isNewLine[:-1] | isNewPage[:-1]
+        lineStarts[starts] = 1
+        lineIds = numpy.cumsum(lineStarts) - 1
+
+        pageStarts = numpy.zeros(len(codes), numpy.int64)
+        pageStarts[1:] = isNewPage[:-1]
+        pageStarts[starts] = 1
+        pageIds = numpy.cumsum(pageStarts) - 1
+
+        # Width of each line, and number of lines of each page
+        lineWidths = numpy.bincount(lineIds, widths).astype(numpy.int64)
+        pageLines = numpy.bincount(pageIds, isNewLine).astype(numpy.int64) + 1
+
+        # Maximum over the lines and pages of each string
+        maxWidths = numpy.maximum.reduceat(lineWidths, lineIds[starts])
+        maxLines = numpy.minimum(numpy.maximum.reduceat(pageLines, pageIds[starts]), self.maxLines)
+
+        for i, width, lines in zip(simple, maxWidths.tolist(), maxLines.tolist()):
+            extents[i] = (width, lines * self.lineHeight)
+
+        return extents
+
+
+# Decode a chunk of a stream of FF7 text strings for the codec with the given
+# name. The 0xff terminator of each string is decoded to U+0000. Unless this
+# is the final chunk, decoding stops before a code which is cut off at the
+# end. Returns the decoded text and the number of bytes consumed.
+def _decodeChunk(data, errors, final, name, decoder):
+    if errors != "strict":
+        raise UnicodeError, "Unsupported error handling '%s' for codec %s" % (errors, name)
+
+    charmap, runs, table = decoder
+
+    data = str(data)
+    dataSize = len(data)
+    text = []
+
+    i = 0
+    while i < dataSize:
+
+        # Run of characters with a fixed translation
+        j = runs.match(data, i).end()
+        if j > i:
+            text.append(codecs.charmap_decode(data[i:j], "strict", charmap)[0])
+            i = j
+
+            if i >= dataSize:
+                break
+
+        # Control code
+        t = table[ord(data[i])]
+        if t is None:
+
+            # End of string
+            text.append(u"\0")
             i += 1
+            continue
+
+        try:
+            t, i = t(data, i + 1)
+        except _TruncatedError as e:
+            if not final:
+                break
+            raise UnicodeDecodeError(name, data, i, dataSize, str(e))
+        except IndexError as e:
+            raise UnicodeDecodeError(name, data, i, i + 1, str(e))
 
-            if c == 0xdd:
+        text.append(t)
+
+    return u"".join(text), i
+
+
+# Encode a chunk of unicode text to a stream of FF7 text strings for the codec
+# with the given name. Each U+0000 character is encoded as a 0xff string
+# terminator. Unless this is the final chunk, an unfinished escape or command
+# sequence at the end is left unencoded. Returns the encoded data and the
+# number of characters consumed.
+def _encodeChunk(text, errors, final, name, field, japanese):
+    if errors != "strict":
+        raise UnicodeError, "Unsupported error handling '%s' for codec %s" % (errors, name)
+
+    textSize = len(text)
 
-                # WAIT command, skip args
-                i += 2
+    if not final:
 
-            elif c == 0xde or c == 0xe1:
+        # Find the last token of the last string, a {NEW} command is also
+        # kept back because a following newline is stripped
+        i = text.rfind(u"\0") + 1
+        while i < textSize:
+            m = _tokenPattern.match(text, i)
+            literal, escape, command, closing = m.groups()
 
-                # Decimal variable, assume max. 5 digits (0..65535)
-                lineWidth += charWidth(0x10, fixed, metrics) * 5  # '0'
+            if escape == u"" or (command is not None and (not closing or (command == u"NEW" and m.end() == textSize))):
+                textSize = i
+                break
 
-            elif c == 0xdf:
+            i = m.end()
 
-                # Hexadecimal variable, assume max. 4 digits (0..FFFF)
-                lineWidth += charWidth(0x21, fixed, metrics) * 4  # 'A'
+    pieces = []
 
-            elif c == 0xe2:
+    start = 0
+    while start <= textSize:
+        end = text.find(u"\0", start, textSize)
+        if end < 0:
+            end = textSize
 
-                # STR command, get length and skip args
-                length = struct.unpack_from("<H", data, i + 2)[0]
-                i += 4
+        try:
+            pieces.append(encode(text[start:end], field, japanese)[:-1])
+        except (IndexError, ValueError) as e:
+            raise UnicodeEncodeError(name, unicode(text), start, end, unicode(e).encode("ascii", "backslashreplace"))
 
-                lineWidth += charWidth(0x37, fixed, metrics) * length  # 'W'
+        start = end + 1
 
-            elif c == 0xe9:
+    return "\xff".join(pieces), textSize
 
-                # Toggle fixed-width character spacing
-                fixed = not fixed
 
-    if lineWidth > maxWidth:
-        maxWidth = lineWidth
-    if numLines > maxLines:
-        maxLines = numLines
+# Return the codec information for a FF7 text variant.
+def _makeCodecInfo(name, field, japanese):
+    if field:
+        decoder = fieldDecoderJP if japanese else fieldDecoder
+    else:
+        decoder = kernelDecoderJP if japanese else kernelDecoder
+
+    def encodeText(input, errors = "strict"):
+        return _encodeChunk(input, errors, True, name, field, japanese)
+
+    def decodeText(input, errors = "strict"):
+        return _decodeChunk(input, errors, True, name, decoder)
+
+    class IncrementalEncoder(codecs.BufferedIncrementalEncoder):
+        def _buffer_encode(self, input, errors, final):
+            return _encodeChunk(input, errors, final, name, field, japanese)
+
+    class IncrementalDecoder(codecs.BufferedIncrementalDecoder):
+        def _buffer_decode(self, input, errors, final):
+            return _decodeChunk(input, errors, final, name, decoder)
+
+    class StreamWriter(codecs.StreamWriter):
+        def encode(self, input, errors = "strict"):
+            return encodeText(input, errors)
+
+    class StreamReader(codecs.StreamReader):
+        def decode(self, input, errors = "strict"):
+            return _decodeChunk(input, errors, False, name, decoder)
+
+    return codecs.CodecInfo(encodeText, decodeText, StreamReader, StreamWriter, IncrementalEncoder, IncrementalDecoder, name)
+
+# Codecs for all FF7 text variants
+_codecInfos = {
+    "ff7-field": _makeCodecInfo("ff7-field", True, False),
+    "ff7-kernel": _makeCodecInfo("ff7-kernel", False, False),
+    "ff7-field-jp": _makeCodecInfo("ff7-field-jp", True, True),
+    "ff7-kernel-jp": _makeCodecInfo("ff7-kernel-jp", False, True),
+}
 
-    if maxLines > 13:
-        maxLines = 13
+# Codec search function
+def _searchCodec(name):
+    return _codecInfos.get(name.replace("_", "-"))
 
-    return (maxWidth, maxLines * lineHeight)
+codecs.register(_searchCodec)
@@ -8,6 +8,14 @@
 # copyright notice and this permission notice appear in all copies.
 #
 
+import array
+import collections
+import cPickle
+import hashlib
+import heapq
+import itertools
+import os
+import sqlite3
 import struct
 
 import lzss
@@ -72,8 +80,9 @@ class MapData:
 
         self.sections[Section.EVENT] = data
 
-    # Write the map to a file object, truncating the file.
-    def writeToFile(self, fileobj):
+    # Write the map to a file object, truncating the file. The 'level'
+    # specifies the LZSS compression level.
+    def writeToFile(self, fileobj, level = lzss.FAST):
         mapData = ""
 
         # Create the pointer table
@@ -87,7 +96,7 @@ class MapData:
             mapData += data
 
         # Compress the map data
-        cmpData = lzss.compress(mapData)
+        cmpData = lzss.compress(mapData, level)
 
         # Write to file
         fileobj.seek(0)
@@ -96,6 +105,29 @@ class MapData:
         fileobj.write(cmpData)
 
 
+# Read only the event section of a field map from an open file object. As
+# the event section comes first, this only decompresses the start of the map.
+def readEventSection(fileobj):
+
+    # Read the file data
+    data = fileobj.read()
+
+    compressedSize = struct.unpack_from("<L", data)[0]
+
+    decompressor = lzss.Decompressor()
+    decompressor.feed(data[4:4 + compressedSize])
+
+    # Parse the pointer table
+    numSections = Section.NUM_SECTIONS
+    tableSize = numSections * 4
+
+    pointers = struct.unpack("<%dL" % numSections, decompressor.read(tableSize))
+
+    # The event section immediately follows the table
+    size = pointers[Section.EVENT + 1] - pointers[Section.EVENT]
+    return EventSection(decompressor.read(size))
+
+
 # Field map event section
 class EventSection:
 
@@ -148,6 +180,9 @@ class EventSection:
         if (len(self.scriptCode) + self.scriptBaseAddress) in self.scriptEntryAddresses:
             self.scriptCode.append(Op.RET)  # the SNW_W field has (unused) pointers after the end of the code
 
+        # Decode the script instructions
+        index = self.instructionIndex = InstructionIndex(self.scriptCode)
+
         # The default script of each actor continues after the first RET
         # instruction. In order to include the following code in control
         # flow analyses we add a 33rd element to each script entry table
@@ -165,12 +200,20 @@ class EventSection:
                     self.scriptEntryAddresses.add(entry)
                     break
                 else:
-                    codeOffset += instructionSize(self.scriptCode, codeOffset)
+                    position = index.find(codeOffset)
+                    codeOffset += index.sizes[position] if position >= 0 else instructionSize(self.scriptCode, codeOffset)
 
         # Also look for double-RET instructions in regular scripts and
-        # add pseudo entry points after them
+        # add pseudo entry points after them (scanning a script a second
+        # time can't find any new entry points, so each script is only
+        # scanned once)
+        scannedScripts = set()
         for i in xrange(numActors):
             for j in xrange(1, 32):
+                if self.actorScripts[i][j] in scannedScripts:
+                    continue
+
+                scannedScripts.add(self.actorScripts[i][j])
                 codeOffset = self.actorScripts[i][j] - self.scriptBaseAddress
 
                 while codeOffset < (len(self.scriptCode) - 2):
@@ -183,7 +226,8 @@ class EventSection:
 
                         codeOffset += 2
                     else:
-                        codeOffset += instructionSize(self.scriptCode, codeOffset)
+                        position = index.find(codeOffset)
+                        codeOffset += index.sizes[position] if position >= 0 else instructionSize(self.scriptCode, codeOffset)
 
                         if (codeOffset + self.scriptBaseAddress) in self.scriptEntryAddresses:
                             break  # stop at next script
@@ -222,11 +266,11 @@ class EventSection:
 
     # Return the list of all strings as unicode objects.
     def getStrings(self, japanese = False):
-        return [ff7text.decodeField(s, japanese) for s in self.stringData]
+        return ff7text.decodeMany(self.stringData, True, japanese)
 
     # Replace the entire string list.
     def setStrings(self, stringList, japanese = False):
-        self.stringData = [ff7text.encode(s, True, japanese) for s in stringList]
+        self.stringData = ff7text.encodeMany(stringList, True, japanese)
 
     # Return the list of extra data blocks.
     def getExtras(self):
@@ -479,6 +523,18 @@ def instructionSize(code, offset):
     return size
 
 
+# Return true if the instruction at the given offset has a valid opcode.
+def isLegal(code, offset):
+    op = code[offset]
+
+    if op == Op.SPCAL:
+        return code[offset + 1] in specialOpcodes
+    elif op == Op.KAWAI:
+        return code[offset + 1] >= 1
+    else:
+        return opcodes[op][1] >= 0
+
+
 # If the instruction at the given offset is a jump or branch instruction,
 # return the jump target offset. Otherwise, return None.
 def targetOffset(code, offset):
@@ -508,45 +564,144 @@ def targetOffset(code, offset):
         return None
 
 
+# Opcodes which halt the control flow
+exitOpcodes = frozenset([Op.RET, Op.RETTO, Op.GMOVR])
+
+# Opcodes of unconditional jumps
+jumpOpcodes = frozenset([Op.SKIP, Op.LSKIP, Op.BACK, Op.LBACK])
+
+# Opcodes of conditional branches
+branchOpcodes = frozenset([Op.IF, Op.LIF, Op.IF2, Op.LIF2, Op.IF2U, Op.LIF2U,
+                           Op.KEYQ, Op.KEYON, Op.KEYOFF, Op.PRTYQ, Op.MEMBQ])
+
 # Return true if the instruction at the given offset halts the control flow.
 def isExit(code, offset):
-    return code[offset] in (Op.RET, Op.RETTO, Op.GMOVR)
+    return code[offset] in exitOpcodes
 
 # Return true if the instruction at the given offset is an unconditional jump.
 def isJump(code, offset):
-    return code[offset] in (Op.SKIP, Op.LSKIP, Op.BACK, Op.LBACK)
+    return code[offset] in jumpOpcodes
 
 # Return true if the instruction at the given offset is a conditional branch.
 def isBranch(code, offset):
-    return code[offset] in (Op.IF, Op.LIF, Op.IF2, Op.LIF2, Op.IF2U, Op.LIF2U,
-                            Op.KEYQ, Op.KEYON, Op.KEYOFF, Op.PRTYQ, Op.MEMBQ)
+    return code[offset] in branchOpcodes
+
+# Operand bytes as printed by the disassembler
+_hexOperands = [" %02x" % b for b in xrange(256)]
+
+# Sizes of instructions by opcode, for the InstructionIndex. Illegal opcodes
+# are skipped as one byte. Opcodes which need a closer look at the operands are
+# listed in _specialOpcodes.
+_instructionSizes = [max(size + 1, 1) for mnemonic, size in opcodes]
+_specialOpcodes = frozenset([Op.SPCAL, Op.KAWAI]) | jumpOpcodes | branchOpcodes
+
+# Decoded instructions of a script code block, stored in array columns which
+# are indexed by instruction number: offset, opcode, SPCAL sub-opcode (-1 for
+# other instructions), size, and jump target offset (-1 for instructions which
+# are not jumps or branches). The 'positions' column maps each code offset to
+# the number of the instruction starting there, or -1.
+class InstructionIndex:
+
+    # Decode the instructions of a script code block.
+    def __init__(self, code):
+        offsets = []
+        ops = []
+        subOps = []
+        sizes = []
+        targets = []
+
+        positions = array.array('i', [-1]) * len(code)
+
+        codeSize = len(code)
+        offset = 0
+        while offset < codeSize:
+            op = code[offset]
+            size = _instructionSizes[op]
+            subOp = -1
+            target = -1
+
+            if op not in _specialOpcodes:
+                if offset + size > codeSize:
+                    size = codeSize - offset  # truncated instruction
+
+            elif offset + 1 >= codeSize:
+                size = 1  # truncated instruction at end of code
+
+            else:
+                if op == Op.SPCAL:
+                    subOp = code[offset + 1]
+
+                if isLegal(code, offset):
+                    size = instructionSize(code, offset)
+
+                    if offset + size > codeSize:
+                        size = codeSize - offset  # truncated instruction
+                    else:
+                        target = targetOffset(code, offset)
+                        if target is None:
+                            target = -1
+
+                elif op == Op.SPCAL:
+                    size = 2  # illegal sub-opcode
+                else:
+                    size = 1  # illegal opcode
+
+            positions[offset] = len(offsets)
+            offsets.append(offset)
+            ops.append(op)
+            subOps.append(subOp)
+            sizes.append(size)
+            targets.append(target)
+
+            offset += size
+
+        self.offsets = array.array('i', offsets)
+        self.opcodes = array.array('B', ops)
+        self.subOpcodes = array.array('h', subOps)
+        self.sizes = array.array('H', sizes)
+        self.targets = array.array('i', targets)
+        self.positions = positions
+
+    # Return the number of instructions.
+    def __len__(self):
+        return len(self.offsets)
+
+    # Return the number of the instruction at the given offset, or -1 if no
+    # instruction starts there.
+    def find(self, offset):
+        if offset < 0 or offset >= len(self.positions):
+            return -1
+        return self.positions[offset]
 
 
 # Build and return the control flow graph, a dictionary mapping addresses to
-# BasicBlock objects.
-def buildCFG(code, baseAddress, entryAddresses):
+# BasicBlock objects. If no InstructionIndex of the code is given, one is
+# created.
+def buildCFG(code, baseAddress, entryAddresses, index = None):
+    if index is None:
+        index = InstructionIndex(code)
+
+    opcodes = index.opcodes
+    sizes = index.sizes
+    targets = index.targets
 
     # Find the addresses of the leaders, starting with the supplied set of
     # entry addresses
     leaders = set(entryAddresses)
 
-    offset = 0
-    while offset < len(code):
-        nextOffset = offset + instructionSize(code, offset)
+    for offset, op, size, target in itertools.izip(index.offsets, opcodes, sizes, targets):
+        nextAddr = offset + size + baseAddress
 
         # Instructions following exit points are leaders
-        if isExit(code, offset):
-            leaders.add(nextOffset + baseAddress)
+        if op in exitOpcodes:
+            leaders.add(nextAddr)
         else:
-            target = targetOffset(code, offset)
 
             # Targets of jump and branches, and the instructions following
             # a jump or branch, are leaders
-            if target is not None:
+            if target != -1:
                 leaders.add(target + baseAddress)
-                leaders.add(nextOffset + baseAddress)
-
-        offset = nextOffset
+                leaders.add(nextAddr)
 
     # For each leader, assemble the corresponding basic block, building
     # the graph
@@ -564,10 +719,19 @@ def buildCFG(code, baseAddress, entryAddresses):
 
         block = BasicBlock()
 
+        # Leaders normally lie on instruction boundaries, otherwise the
+        # instructions are decoded from this offset on
+        i = index.find(offset)
+
         while True:
 
             # Append one instruction
-            size = instructionSize(code, offset)
+            if i >= 0:
+                size = sizes[i]
+                i += 1
+            else:
+                size = instructionSize(code, offset)
+
             block.instructions.append(offset)
 
             addr += size
@@ -583,15 +747,23 @@ def buildCFG(code, baseAddress, entryAddresses):
         assert len(block.instructions) > 0
         lastInstruction = block.instructions[-1]
 
-        if isJump(code, lastInstruction):      # one successor: the jump target
-            block.succ = set([targetOffset(code, lastInstruction) + baseAddress])
-        elif isBranch(code, lastInstruction):  # two successors: the branch target and the next instruction
+        i = index.find(lastInstruction)
+        if i >= 0:
+            op = opcodes[i]
+            target = targets[i]
+        else:
+            op = code[lastInstruction]
+            target = targetOffset(code, lastInstruction)
+
+        if op in jumpOpcodes:      # one successor: the jump target
+            block.succ = set([target + baseAddress])
+        elif op in branchOpcodes:  # two successors: the branch target and the next instruction
             if offset >= len(code):
                 raise IndexError, "Control flow reaches end of script code"
-            block.succ = set([targetOffset(code, lastInstruction) + baseAddress, addr])
-        elif isExit(code, lastInstruction):    # no successors
+            block.succ = set([target + baseAddress, addr])
+        elif op in exitOpcodes:    # no successors
             block.succ = set()
-        else:                                  # one successor: the next instruction
+        else:                      # one successor: the next instruction
             if offset >= len(code):
                 raise IndexError, "Control flow reaches end of script code"
             block.succ = set([addr])
@@ -625,17 +797,159 @@ def findPaths(graph, entryAddress, path = []):
         return [path]  # cycle reached
 
 
+# Propagate abstract states through a control flow graph until a fixpoint is
+# reached, using a worklist of blocks whose start state has changed.
+#
+# The 'entryStates' dictionary maps entry addresses to their initial states.
+# The 'transfer' function is called with a block and the state at the start
+# of the block, and returns the state at the end of the block. The 'join'
+# function combines two states. States must be comparable for equality.
+#
+# This function returns a dictionary mapping the addresses of all blocks
+# reachable from the entry points to the states at their starts.
+def dataflow(graph, entryStates, transfer, join):
+    states = {}
+    worklist = collections.deque()
+    queued = set()
+
+    for addr in sorted(entryStates):
+        states[addr] = entryStates[addr]
+        worklist.append(addr)
+        queued.add(addr)
+
+    while worklist:
+        addr = worklist.popleft()
+        queued.discard(addr)
+
+        block = graph[addr]
+        endState = transfer(block, states[addr])
+
+        for succ in sorted(block.succ):
+            oldState = states.get(succ)
+            if oldState is None:
+                newState = endState
+            else:
+                newState = join(oldState, endState)
+
+            if newState != oldState:
+                states[succ] = newState
+
+                if succ not in queued:
+                    worklist.append(succ)
+                    queued.add(succ)
+
+    return states
+
+
+# Determine the set of addresses of all blocks reachable from the given entry
+# points.
+def reachableBlocks(graph, entryAddresses):
+    states = dataflow(graph, dict.fromkeys(entryAddresses, True), lambda block, state: state, lambda a, b: a)
+    return set(states)
+
+
+# Determine for each reachable block the set of entry points from which it
+# can be reached. Returns a dictionary mapping block addresses to frozensets
+# of entry addresses.
+def reachingEntries(graph, entryAddresses):
+    entryStates = {addr: frozenset([addr]) for addr in entryAddresses}
+    return dataflow(graph, entryStates, lambda block, state: state, lambda a, b: a | b)
+
+
+# The state of the window analysis is a tuple holding, for each of the four
+# windows, a frozenset of possible (instruction, special) pairs. The
+# instruction is the offset of the WSIZE/WSIZW instruction which defines the
+# window, or None if the window is not defined. The special flag is set by
+# WSPCL.
+_initialWindowState = (frozenset([(None, False)]),) * 4
+
+def _joinWindowStates(a, b):
+    return tuple(x | y for x, y in zip(a, b))
+
+# Apply the window instructions of a block to a window state and return the
+# resulting state. If a 'windows' dictionary is passed, the possible windows
+# of each MES and ASK instruction are added to it.
+def _windowTransfer(code, block, state, windows = None):
+    state = list(state)
+
+    for offset in block.instructions:
+        op = code[offset]
+
+        if op in (Op.WSIZE, Op.WSIZW):
+
+            # Remember the offset of the instruction which defines the window
+            windowId = code[offset + 1] & 3
+            state[windowId] = frozenset((offset, special) for instr, special in state[windowId])
+
+        elif op == Op.WSPCL:
+
+            windowId = code[offset + 1] & 3
+            special = (code[offset + 2] != 0)
+            state[windowId] = frozenset((instr, special) for instr, s in state[windowId])
+
+        elif op == Op.WREST:
+
+            windowId = code[offset + 1] & 3
+            state[windowId] = _initialWindowState[windowId]
+
+        elif windows is not None and op in (Op.MES, Op.ASK):
+
+            if op == Op.MES:
+                windowId = code[offset + 1] & 3
+            else:
+                windowId = code[offset + 2] & 3
+
+            instrs = windows.setdefault(offset, set())
+            instrs |= set(instr for instr, special in state[windowId] if not special)
+
+    return tuple(state)
+
+# Determine the windows in which each MES and ASK instruction reachable from
+# the given entry points can be displayed, by abstract interpretation of the
+# (filtered) script code. Windows with the special flag set are not
+# considered.
+#
+# This function returns a dictionary mapping the offset of each reachable MES
+# and ASK instruction to the set of offsets of the WSIZE/WSIZW instructions
+# defining the windows. The set contains None if the instruction may be
+# reached without a window being defined.
+def findWindows(graph, code, entryAddresses):
+    entryStates = dict.fromkeys(entryAddresses, _initialWindowState)
+    states = dataflow(graph, entryStates, lambda block, state: _windowTransfer(code, block, state), _joinWindowStates)
+
+    windows = {}
+    for addr, state in states.iteritems():
+        _windowTransfer(code, graph[addr], state, windows)
+
+    return windows
+
+
 # Remove instructions from the blocks of a code flow graph, only keeping those
 # in the specified list. The passed-in graph is modified by this function.
 # SPCAL 2-byte opcodes which should be kept can be specified as 0x0fxx.
-def filterInstructions(graph, code, keep):
+# An InstructionIndex of the code may be passed in to speed up the lookup.
+def filterInstructions(graph, code, keep, index = None):
+    if index is None:
+        index = InstructionIndex(code)
+
+    keep = set(keep)
+    positions = index.positions
+    opcodes = index.opcodes
+    subOpcodes = index.subOpcodes
+
     for block in graph.values():
         newInstructions = []
 
         for offset in block.instructions:
-            op = code[offset]
-            if op == Op.SPCAL:
-                op = (op << 8) | code[offset + 1]
+            i = positions[offset]
+            if i >= 0:
+                op = opcodes[i]
+                if op == Op.SPCAL:
+                    op = (op << 8) | subOpcodes[i]
+            else:
+                op = code[offset]
+                if op == Op.SPCAL:
+                    op = (op << 8) | code[offset + 1]
 
             if op in keep:
                 newInstructions.append(offset)
@@ -645,9 +959,12 @@ def filterInstructions(graph, code, keep):
 
 # Recursively find all possible exits from a given block which lie
 # outside of a specified address range.
-def possibleExitsFrom(graph, block, minAddr, maxAddr, consideredBlocks = set()):
+def possibleExitsFrom(graph, block, minAddr, maxAddr, consideredBlocks = None):
     exits = set()
 
+    if consideredBlocks is None:
+        consideredBlocks = set()
+
     if block in consideredBlocks:
         return exits
     else:
@@ -662,122 +979,293 @@ def possibleExitsFrom(graph, block, minAddr, maxAddr, consideredBlocks = set()):
     return exits
 
 
-# Reduce a (filtered) graph in order to lower the number of paths to examine
-# for cases where we're only interested in the possible sequence of
-# instructions. The passed-in graph is modified by this function.
-def reduce(graph, entryAddresses):
-
-    while True:
-        nothingChanged = True
-
-        # Eliminate the condition from simple 'if c then b' constructs by
-        # assuming that the inner block is always executed
-        for blockAddr, block in graph.iteritems():
-            if len(block.succ) == 2:
-                sortedSuccs = sorted(list(block.succ))
-                innerAddr = sortedSuccs[0]
-                exitAddr = sortedSuccs[1]
-
-                innerBlock = graph[innerAddr]
-                if possibleExitsFrom(graph, innerBlock, innerAddr, exitAddr) == set([exitAddr]):
-#                    print "eliminating %s -> %04x" % (map(hex, list(block.succ)), innerAddr)
-                    block.succ = set([innerAddr])
-                    nothingChanged = False
-
-        if nothingChanged:
-            break
-                
-    while True:
-        nothingChanged = True
-
-        # Skip blocks with no (filtered) instructions as long as it reduces
-        # the number of paths
-        for blockAddr, block in graph.iteritems():
-            newSucc = set()
-
-            for addr in block.succ:
-                succBlock = graph[addr]
-                if not succBlock.instructions:
-                    newSucc |= succBlock.succ
-                else:
-                    newSucc |= set([addr])
-
-            newSucc.discard(blockAddr)  # remove simple cycles
-
-            if newSucc != block.succ and len(newSucc) < 3:  # avoid excessive branching
-#                print "reducing %s -> %s" % (map(hex, list(block.succ)), map(hex, list(newSucc)))
-                block.succ = newSucc
-                nothingChanged = False
+# Find all possible exits from the block at the given address which lie
+# outside of a specified address range, like possibleExitsFrom(). Returns a
+# tuple of the set of exits and the set of addresses of the blocks examined.
+def _regionExits(graph, startAddr, minAddr, maxAddr):
+    exits = set()
+    visited = set([startAddr])
+    stack = [startAddr]
+
+    while stack:
+        for succ in graph[stack.pop()].succ:
+            if succ >= minAddr and succ < maxAddr:
+                if succ not in visited:
+                    visited.add(succ)
+                    stack.append(succ)
+            else:
+                exits.add(succ)
+
+    return exits, visited
+
+
+# Visit the blocks of a graph in the order given by their positions in the
+# graph, calling 'visit(pos)' for each one. 'visit' returns a list of the
+# positions of blocks to visit again. This gives the same results as
+# repeatedly sweeping over all blocks until nothing changes, as long as
+# 'visit' returns all blocks whose outcome may have changed: blocks behind
+# the current one are visited in the same sweep, all others in the next one.
+def _sweep(numBlocks, visit):
+    pending = range(numBlocks)
+
+    while pending:
+        queued = set(pending)
+        later = []  # heap of blocks to visit in this sweep
+        nextSweep = set()
+
+        i = 0
+        while True:
+            if later and (i >= len(pending) or later[0] < pending[i]):
+                pos = heapq.heappop(later)
+            elif i < len(pending):
+                pos = pending[i]
+                i += 1
+            else:
+                break
 
-        if nothingChanged:
-            break
+            queued.discard(pos)
 
-    while True:
-        nothingChanged = True
+            for p in visit(pos):
+                if p <= pos:
+                    nextSweep.add(p)
+                elif p not in queued:
+                    queued.add(p)
+                    heapq.heappush(later, p)
 
-        # Remove orphaned blocks
-        referencedBlocks = set(entryAddresses)
-        for block in graph.values():
-            referencedBlocks |= block.succ
+        pending = sorted(nextSweep)
 
-        for addr in graph.keys()[:]:
-            if addr not in referencedBlocks:
-#                print "deleting %04x" % addr
-                del graph[addr]
-                nothingChanged = False
 
-        if nothingChanged:
-            break
+# Reduce a (filtered) graph in order to lower the number of paths to examine
+# for cases where we're only interested in the possible sequence of
+# instructions. The passed-in graph is modified by this function.
+def reduce(graph, entryAddresses):
+    order = graph.keys()
+    position = dict((addr, pos) for pos, addr in enumerate(order))
+
+    # Eliminate the condition from simple 'if c then b' constructs by
+    # assuming that the inner block is always executed. The exits of each
+    # (inner block, exit address) range are memoized until one of the
+    # blocks examined for it changes.
+    exitCache = {}
+    rangesVisiting = collections.defaultdict(set)  # block address -> ranges
+    rangeUsers = collections.defaultdict(set)      # range -> block positions
+
+    def eliminateCondition(pos):
+        blockAddr = order[pos]
+        block = graph[blockAddr]
+
+        if len(block.succ) != 2:
+            return []
+
+        innerAddr, exitAddr = sorted(block.succ)
+        key = (innerAddr, exitAddr)
+
+        rangeUsers[key].add(pos)
+
+        exits = exitCache.get(key)
+        if exits is None:
+            exits, visited = _regionExits(graph, innerAddr, innerAddr, exitAddr)
+            exitCache[key] = exits
+            for addr in visited:
+                rangesVisiting[addr].add(key)
+
+        if exits != set([exitAddr]):
+            return []
+
+#        print "eliminating %s -> %04x" % (map(hex, list(block.succ)), innerAddr)
+        block.succ = set([innerAddr])
+
+        # Re-examine the blocks whose ranges include this block
+        changed = []
+        for key in rangesVisiting.pop(blockAddr, ()):
+            exitCache.pop(key, None)
+            changed.extend(rangeUsers.pop(key, ()))
+
+        return changed
+
+    _sweep(len(order), eliminateCondition)
+
+    # Skip blocks with no (filtered) instructions as long as it reduces
+    # the number of paths
+    pred = collections.defaultdict(set)
+    for blockAddr, block in graph.iteritems():
+        for addr in block.succ:
+            pred[addr].add(blockAddr)
+
+    def skipEmptyBlocks(pos):
+        blockAddr = order[pos]
+        block = graph[blockAddr]
+
+        newSucc = set()
+
+        for addr in block.succ:
+            succBlock = graph[addr]
+            if not succBlock.instructions:
+                newSucc |= succBlock.succ
+            else:
+                newSucc.add(addr)
+
+        newSucc.discard(blockAddr)  # remove simple cycles
+
+        if newSucc == block.succ or len(newSucc) >= 3:  # avoid excessive branching
+            return []
+
+#        print "reducing %s -> %s" % (map(hex, list(block.succ)), map(hex, list(newSucc)))
+        for addr in block.succ - newSucc:
+            pred[addr].discard(blockAddr)
+        for addr in newSucc - block.succ:
+            pred[addr].add(blockAddr)
+
+        block.succ = newSucc
+
+        # Re-examine this block, and the blocks skipping over it
+        changed = [pos]
+        if not block.instructions:
+            changed.extend(position[addr] for addr in pred[blockAddr])
+
+        return changed
+
+    _sweep(len(order), skipEmptyBlocks)
+
+    # Remove orphaned blocks, by counting the references to each block
+    refCount = dict.fromkeys(graph, 0)
+    for addr in entryAddresses:
+        if addr in refCount:
+            refCount[addr] += 1
+    for block in graph.itervalues():
+        for addr in block.succ:
+            if addr in refCount:
+                refCount[addr] += 1
+
+    orphans = [addr for addr in order if refCount[addr] == 0]
+    while orphans:
+        addr = orphans.pop()
+#        print "deleting %04x" % addr
+        for succ in graph.pop(addr).succ:
+            if succ in refCount:
+                refCount[succ] -= 1
+                if refCount[succ] == 0:
+                    orphans.append(succ)
 
 
 # Dissasemble script code, optionally printing labels before instructions.
 # The 'baseAddress' specifies the (virtual) start address of the first
-# script instruction.
-def disassemble(code, baseAddress = 0, labels = []):
-    s = ""
+# script instruction. An InstructionIndex of the code may be passed in to
+# avoid decoding it again.
+def disassemble(code, baseAddress = 0, labels = [], index = None):
+    if index is None:
+        index = InstructionIndex(code)
 
-    offset = 0
-    while offset < len(code):
-        addr = offset + baseAddress
+    # Group the labels by address, keeping their order
+    labelsAt = {}
+    for labelText, labelOffset in labels:
+        labelsAt.setdefault(labelOffset, []).append(labelText)
 
-        firstLabel = True
-        for labelText, labelOffset in labels:
-            if labelOffset == addr:
-                if firstLabel:
-                    s += '\n'
-                    firstLabel = False
+    lines = []
 
-                s += "%s:" % labelText
-                s += '\n'
+    for i, (offset, op, size) in enumerate(itertools.izip(index.offsets, index.opcodes, index.sizes)):
+        addr = offset + baseAddress
 
-        format = "%04x: "
-        values = (addr, )
+        if addr in labelsAt:
+            lines.append('\n')
+            for labelText in labelsAt[addr]:
+                lines.append("%s:\n" % labelText)
 
-        op = code[offset]
-        offset += 1
+        end = offset + size
 
         mnemonic, size = opcodes[op]
+        start = offset + 1
 
         if op == Op.SPCAL:  # first operand byte is sub-opcode
-            subOp = code[offset]
-            offset += 1
-            mnemonic, size = specialOpcodes[subOp]
+            mnemonic, size = specialOpcodes.get(index.subOpcodes[i], ("", -1))
+            start += 1
         elif op == Op.KAWAI:  # variable size given by first operand byte
-            size = code[offset] - 1
+            size = code[start] - 1 if start < len(code) else -1
 
         if size < 0:  # illegal opcode
             mnemonic = "<%02x>" % op
-            size = 0
+            end = start
+
+        lines.append("%04x: %s%s\n" % (addr, mnemonic, "".join([_hexOperands[b] for b in code[start:end]])))
+
+    return "".join(lines)
+
+
+# Persistent cache of script analysis results, stored in an SQLite database
+# file. Results are stored by kind of analysis, and keyed by a hash of the
+# script code, the actor names and script entry tables of an event section,
+# and a version string which should change whenever the analysis does. The
+# cache may be passed to worker processes, which open their own connections
+# to the database.
+class AnalysisCache:
+
+    # Create a cache stored in the given database file, which is created
+    # when it is first used.
+    def __init__(self, fileName, version):
+        self.fileName = fileName
+        self.version = version
+
+        self.db = None
+        self.pid = None
+
+    # Don't pass the database connection to other processes.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["db"] = None
+        return state
+
+    # Return the database connection of the current process.
+    def connection(self):
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.fileName, timeout = 60)
+            self.db.execute("PRAGMA synchronous = OFF")  # it's only a cache
+            self.db.execute("CREATE TABLE IF NOT EXISTS analysis (kind TEXT, key TEXT, result BLOB, PRIMARY KEY (kind, key))")
+            self.db.commit()
+            self.pid = os.getpid()
+
+        return self.db
+
+    # Return the cache key of an event section.
+    def key(self, event):
+        code = bytearray(event.scriptCode)
+
+        # Window positions and sizes are not part of the key, so a script
+        # whose windows were resized by a translation still matches
+        index = event.instructionIndex
+        for offset, op, size in itertools.izip(index.offsets, index.opcodes, index.sizes):
+            if op == Op.WSIZE or op == Op.WSIZW:
+                code[offset + 2:offset + size] = bytearray(size - 2)
+
+        h = hashlib.sha1()
+        h.update(struct.pack("<I", len(self.version)) + self.version)
+        h.update(struct.pack("<IH", len(code), event.scriptBaseAddress) + str(code))
+
+        for name, scripts in zip(event.actorNames, event.actorScripts):
+            h.update(struct.pack("<8sH%dI" % len(scripts), name, len(scripts), *scripts))
+
+        return h.hexdigest()
+
+    # Return the cached result of the given kind of analysis of an event
+    # section, or None if there is none.
+    def get(self, kind, event):
+        row = self.connection().execute("SELECT result FROM analysis WHERE kind = ? AND key = ?", (kind, self.key(event))).fetchone()
+
+        if row is None:
+            return None
+        else:
+            return cPickle.loads(str(row[0]))
 
-        format += "%s"
-        values += (mnemonic, )
-        for i in range(offset, offset + size):
-            format += " %02x"
-            values += (code[i], )
+    # Store the result of the given kind of analysis of an event section.
+    def put(self, kind, event, result):
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
 
-        s += format % values
-        s += '\n'
+        db = self.connection()
+        db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?)", (kind, self.key(event), sqlite3.Binary(data)))
+        db.commit()
 
-        offset += size
+    # Close the database connection of the current process.
+    def close(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
 
-    return s
+        self.db = None
@@ -20,17 +20,32 @@ class ArchiveFile:
     def __init__(self, dirID, index, cmpData = "", rawDataSize = 0):
         self.dirID = dirID
         self.index = index
-        self.cmpData = cmpData
+        self.cmpData = cmpData  # compressed data, None if it needs to be recompressed
         self.rawDataSize = rawDataSize
+        self.data = None        # decompressed data, None if not decompressed yet
 
     # Return the decompressed file data as an 8-bit string.
     def getData(self):
-        return ff7.decompressGzip(self.cmpData)
+        if self.data is None:
+            self.data = ff7.decompressGzip(self.cmpData)
 
-    # Replace the file data and compress it.
+        return self.data
+
+    # Replace the file data. The data is only compressed when needed.
     def setData(self, data):
+        if self.cmpData and data == self.getData():
+            return  # unchanged, keep the original compressed data
+
+        self.data = data
         self.rawDataSize = len(data)
-        self.cmpData = ff7.compressGzip(data)
+        self.cmpData = None
+
+    # Return the compressed file data as an 8-bit string.
+    def getCmpData(self):
+        if self.cmpData is None:
+            self.cmpData = ff7.compressGzip(self.data)
+
+        return self.cmpData
 
 
 # Kernel archive (sequence of gzipped files prefixed with 16-bit size
@@ -42,6 +57,12 @@ class Archive:
         self.name = fileobj.name
         self.fileList = []
 
+        # Maps (dirID, index) to the position of the file in fileList
+        self.fileIndex = {}
+
+        # Maps directory IDs to the positions of their files in fileList
+        self.dirIndex = {}
+
         # Extract all files
         index = 0
         prevDirID = None
@@ -62,18 +83,17 @@ class Archive:
 
             # Read the file data and append it to the list
             cmpData = fileobj.read(cmpDataSize)
-            self.fileList.append(ArchiveFile(dirID, index, cmpData, rawDataSize))
+            self.appendFile(ArchiveFile(dirID, index, cmpData, rawDataSize))
 
             index += 1
 
     # Return the file with the given directory ID and index.
     # Raises IndexError if there is no such file.
     def getFile(self, dirID, index):
-        for f in self.fileList:
-            if f.dirID == dirID and f.index == index:
-                return f
-
-        raise IndexError, "No file with directory ID %d, index %d in archive '%s'" % (dirID, index, self.name)
+        try:
+            return self.fileList[self.fileIndex[(dirID, index)]]
+        except KeyError:
+            raise IndexError, "No file with directory ID %d, index %d in archive '%s'" % (dirID, index, self.name)
 
     # Return the list of all files in the archive.
     def getFiles(self):
@@ -81,31 +101,53 @@ class Archive:
 
     # Return the list of files with a given directory ID (may be empty).
     def directory(self, dirID):
-        return [f for f in self.fileList if f.dirID == dirID]
+        return [self.fileList[i] for i in self.dirIndex.get(dirID, [])]
+
+    # Append a file to the end of the archive and add it to the indexes.
+    # If there already is a file with the same directory ID and index, the
+    # index keeps referring to the existing one.
+    def appendFile(self, f):
+        pos = len(self.fileList)
+        self.fileList.append(f)
+
+        self.fileIndex.setdefault((f.dirID, f.index), pos)
+        self.dirIndex.setdefault(f.dirID, []).append(pos)
 
     # Add a file, possibly replacing a file with the same directory ID and index.
     def addFile(self, f):
-        for i in xrange(len(self.fileList)):
-            if self.fileList[i].dirID == f.dirID and self.fileList[i].index == f.index:
-                self.fileList[i] = f
-                return
+        pos = self.fileIndex.get((f.dirID, f.index))
 
-        self.fileList.append(f)
+        if pos is None:
+            self.appendFile(f)
+        else:
+            self.fileList[pos] = f
+
+    # Write the archive to a file object, truncating the file. If 'workers'
+    # is greater than 1, changed files are compressed in parallel by that
+    # many processes.
+    def writeToFile(self, fileobj, workers = 1):
+
+        # Compress changed files
+        changed = [f for f in self.fileList if f.cmpData is None]
+        results = ff7.parallelMap(ff7.compressGzip, [f.data for f in changed], workers)
+
+        for f, cmpData in zip(changed, results):
+            f.cmpData = cmpData
 
-    # Write the archive to a file object, truncating the file.
-    def writeToFile(self, fileobj):
         fileobj.seek(0)
         fileobj.truncate()
 
         # Write all files
         for f in self.fileList:
 
+            cmpData = f.getCmpData()
+
             # Write the header
-            header = struct.pack("<HHH", len(f.cmpData), f.rawDataSize, f.dirID)
+            header = struct.pack("<HHH", len(cmpData), f.rawDataSize, f.dirID)
             fileobj.write(header)
 
             # Write the file data
-            fileobj.write(f.cmpData)
+            fileobj.write(cmpData)
 
 
 # Kernel string list, as typically found inside a kernel archive (header of
@@ -126,10 +168,13 @@ class StringList:
             offsets.append(struct.unpack_from("<H", data, i*2)[0])
 
         # Extract the strings
+        rawStrings = []
         for offset in offsets:
             rawString, endOfString = self._extract(data, offset, len(data))
             assert endOfString
-            self.stringList.append(ff7text.decodeKernel(rawString, japanese))
+            rawStrings.append(rawString)
+
+        self.stringList = ff7text.decodeMany(rawStrings, False, japanese)
 
     # Extract a single string from the raw data. Returns a tuple consisting
     # of the extracted string and a flag which indicates that the end of the
@@ -208,8 +253,7 @@ class StringList:
         offsets = []
         data = ""
 
-        for string in self.stringList:
-            rawString = ff7text.encode(string, False, self.japanese)
+        for rawString in ff7text.encodeMany(self.stringList, False, self.japanese):
 
             # Already in string data?
             offset = data.find(rawString)
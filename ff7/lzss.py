@@ -8,6 +8,9 @@
 # copyright notice and this permission notice appear in all copies.
 #
 
+import sys
+import array
+
 
 # Final Fantasy VII uses references with 12-bit offsets and 4-bit lengths,
 # corresponding to a 4096-byte window, and reference lengths in the range
@@ -18,183 +21,463 @@ WMASK = 0x0fff    # window offset bit mask
 MAX_REF_LEN = 18  # maximum reference length
 MIN_REF_LEN = 3   # minimum reference length
 
+# Compression levels
+FAST = 1     # greedy parsing, always take the longest match
+LAZY = 2     # lazy matching, defer a match if the next one is longer
+OPTIMAL = 3  # optimal parsing, smallest output but slow
 
-# Decompress an 8-bit string from LZSS format.
-def decompress(data):
 
-    # Input offset and input size
-    i = 0
-    dataSize = len(data)
+# Number of consecutive literals indicated by the lowest bits of a flags
+# byte
+_literalRuns = []
+for flags in xrange(256):
+    run = 0
+    while flags & (1 << run):
+        run += 1
+    _literalRuns.append(run)
 
-    # Output offset and output data
-    j = 0
-    output = ""
 
-    while i < dataSize:
+# Decode LZSS data starting at input offset 'i' into the 'output' buffer at
+# offset 'j', with 'bits' items of the current 'flags' byte remaining.
+# Decoding stops when the output offset reaches 'limit' or when the input
+# is exhausted, including in the middle of a reference. Returns the updated
+# (i, flags, bits, j) tuple.
+def _decode(data, i, flags, bits, output, j, limit):
+    dataSize = len(data)
+
+    while j < limit:
 
-        # Read next flags byte
-        flags = ord(data[i])
-        i += 1
+        if not bits:
 
-        # Process 8 literals or references
-        for bit in xrange(8):
+            # Read next flags byte
             if i >= dataSize:
                 break
 
-            if flags & (1 << bit):
+            flags = data[i]
+            i += 1
+            bits = 8
 
-                # Copy literal value
-                output += data[i]
-                i += 1
-                j += 1
+        if flags & 1:
+
+            # Copy run of literal values
+            run = _literalRuns[flags]
+            if run > limit - j:
+                run = limit - j
+
+            literals = data[i:i + run]
+            run = len(literals)  # may be cut short at end of input
+            if not run:
+                break
+
+            output[j:j + run] = literals
+            i += run
+            j += run
+
+            flags >>= run
+            bits -= run
+
+        else:
+
+            # Resolve dictionary reference
+            # (strange encoding: lower 8 bits of offset in first byte,
+            # upper 4 bits of offset in upper 4 bits of second byte)
+            if i + 1 >= dataSize:
+                break
+
+            offset = data[i] | ((data[i+1] & 0xf0) << 4)
+            length = (data[i+1] & 0x0f) + MIN_REF_LEN
+
+            distance = (j + 0xfee - offset) & WMASK
+            if distance == 0:
+                raise IndexError, "Invalid LZSS reference at input offset %d" % i
+
+            ref = j - distance
+            if distance >= length:
+
+                # Non-overlapping, copy in one go
+                output[j:j + length] = output[ref:ref + length]
 
             else:
 
-                # Resolve dictionary reference
-                # (strange encoding: lower 8 bits of offset in first byte,
-                # upper 4 bits of offset in upper 4 bits of second byte)
-                offset = ord(data[i]) | ((ord(data[i+1]) & 0xf0) << 4)
-                length = (ord(data[i+1]) & 0x0f) + MIN_REF_LEN
-                i += 2
+                # Overlapping, repeat the pattern
+                pattern = output[ref:j]
+                output[j:j + length] = (pattern * (length / distance + 1))[:length]
+
+            i += 2
+            j += length
+
+            flags >>= 1
+            bits -= 1
 
-                ref = j - ((j + 0xfee - offset) & 0xfff)
-                while length > 0:
-                    if ref < 0:  # references before start of output resolve to 0 bytes
-                        output += '\0'
-                    else:
-                        output += output[ref]
+    return (i, flags, bits, j)
 
-                    j += 1
-                    ref += 1
-                    length -= 1
 
-    return output
+# Decompress an 8-bit string from LZSS format. If the size of the
+# decompressed data is known in advance, it can be specified as 'size' to
+# preallocate the output buffer. If a 'limit' is given, decompression stops
+# after that many bytes have been produced.
+def decompress(data, size = 0, limit = None):
+    data = bytearray(data)
 
+    # The output buffer starts with a window's worth of zero bytes, so
+    # references before the start of the output resolve to 0 bytes
+    output = bytearray(WSIZE + size)
 
-# Dictionary for LZSS compression
-class Dictionary:
+    if limit is None:
+        outputLimit = sys.maxint
+    else:
+        outputLimit = WSIZE + limit
+
+    i, flags, bits, j = _decode(data, 0, 0, 0, output, WSIZE, outputLimit)
+
+    if j < outputLimit and i < len(data):
+        raise IndexError, "Premature end of LZSS data"
+
+    if j > outputLimit:
+        j = outputLimit  # the last reference may have exceeded the limit
+
+    return str(buffer(output, WSIZE, j - WSIZE))
+
+
+# Incremental LZSS decompressor. Compressed data is supplied in arbitrary
+# chunks with feed(), and decompressed data is produced on demand by read().
+class Decompressor:
+
+    # Maximum amount of data which may accumulate in the output buffer
+    # before it is trimmed
+    trimThreshold = 0x10000
 
-    # Initialize the dictionary.
     def __init__(self):
+        self.input = bytearray()  # unprocessed input data
+        self.flags = 0            # remaining bits of current flags byte
+        self.bits = 0             # number of remaining bits
+
+        # The output buffer holds the last window of decompressed data
+        # followed by the data not yet read
+        self.output = bytearray(WSIZE)
+        self.readPos = WSIZE
+
+    # Supply more compressed data.
+    def feed(self, data):
+        self.input += data
+
+    # Decompress and return up to 'size' bytes, or as much as possible from
+    # the data supplied so far if 'size' is negative. Returns less data if
+    # more input is needed.
+    def read(self, size = -1):
+        output = self.output
+
+        if size < 0:
+            limit = sys.maxint
+        else:
+            limit = self.readPos + size
+
+        # Decode as much input as necessary
+        if len(output) < limit:
+            i, self.flags, self.bits, j = _decode(self.input, 0, self.flags, self.bits, output, len(output), limit)
+            del self.input[:i]
+
+        # Return the requested data
+        start = self.readPos
+        end = min(len(output), limit)
+        data = str(buffer(output, start, end - start))
+        self.readPos = end
+
+        # Discard data which is neither unread nor needed for resolving
+        # references (in multiples of the window size, so the ring buffer
+        # positions stay the same)
+        trim = (end - WSIZE) & ~WMASK
+        if trim > self.trimThreshold:
+            del output[:trim]
+            self.readPos -= trim
+
+        return data
+
+
+# Match finder for LZSS compression, using hash chains over the window.
+#
+# The input data is prefixed with MAX_REF_LEN zero bytes, corresponding to
+# the initial contents of the decompressor's ring buffer just before the
+# start of the output. Each position in this buffer is hashed by its first
+# MIN_REF_LEN bytes. 'head' maps each hash value to the most recent position
+# with that hash, and 'prev' (a ring of WSIZE entries) links each position
+# to the previous position with the same hash.
+class MatchFinder:
+    hashBits = 15
+    hashSize = 1 << hashBits
+    hashMask = hashSize - 1
+    hashShift = 5  # after MIN_REF_LEN shifts a byte no longer affects the hash
+
+    # Initialize the match finder for the given data.
+    def __init__(self, data):
+        self.buf = '\0' * MAX_REF_LEN + data
+        self.bytes = bytearray(self.buf)
+        self.size = len(self.buf)
+
+        self.head = array.array('l', [-1]) * self.hashSize
+        self.prev = array.array('l', [-1]) * WSIZE
+
+        # Next position to be inserted, and the rolling hash of the
+        # MIN_REF_LEN bytes at that position
+        self.pos = 0
+        self.hash = 0
+        for i in xrange(min(MIN_REF_LEN, self.size)):
+            self.hash = ((self.hash << self.hashShift) ^ self.bytes[i]) & self.hashMask
+
+        # Insert the zero bytes preceding the data
+        self.insert(MAX_REF_LEN)
+
+    # Insert the next 'count' positions into the hash chains.
+    def insert(self, count):
+        b = self.bytes
+        head = self.head
+        prev = self.prev
+        shift = self.hashShift
+        mask = self.hashMask
+
+        pos = self.pos
+        h = self.hash
+        end = pos + count
+
+        lastHashed = self.size - MIN_REF_LEN  # last position with a complete hash
+        while pos < end:
+            if pos <= lastHashed:
+                prev[pos & WMASK] = head[h]
+                head[h] = pos
+
+                if pos < lastHashed:
+                    h = ((h << shift) ^ b[pos + MIN_REF_LEN]) & mask
+
+            pos += 1
+
+        self.pos = pos
+        self.hash = h
+
+    # Find the longest match for the data at the current position, preferring
+    # the most recent one among matches of equal length. Returns an
+    # (offset, length) tuple, with the offset given as a position in the
+    # decompressor's ring buffer. Returns None if there is no match.
+    def find(self):
+        pos = self.pos
+        buf = self.buf
+
+        maxLength = self.size - pos
+        if maxLength > MAX_REF_LEN:
+            maxLength = MAX_REF_LEN
+        if maxLength < MIN_REF_LEN:
+            return None
+
+        prev = self.prev
+        minPos = pos - WSIZE  # the FF7 LZSS decompressor can't handle a reference to the current ring position
+        if minPos < -1:
+            minPos = -1  # end of chain
+
+        bestPos = -1
+        bestLength = MIN_REF_LEN - 1
+
+        candidate = self.head[self.hash]
+        while candidate > minPos:
+
+            # Only examine candidates which would improve on the best match
+            if buf[candidate:candidate + bestLength + 1] == buf[pos:pos + bestLength + 1]:
+                length = bestLength + 1
+                while length < maxLength and buf[candidate + length] == buf[pos + length]:
+                    length += 1
+
+                bestPos = candidate
+                bestLength = length
+
+                if length == maxLength:
+                    break
+
+            candidate = prev[candidate & WMASK]
+
+        if bestPos < 0:
+            return None
+
+        return ((bestPos + WSIZE - 2*MAX_REF_LEN) & WMASK, bestLength)
+
+
+# Parse the data into literals and references by always taking the longest
+# match.
+def _parseGreedy(finder, dataSize):
+    items = []
+
+    i = 0
+    while i < dataSize:
+        match = finder.find()
+        if match is None:
+            length = 1
+        else:
+            length = match[1]
 
-        # For each reference length there is one dictionary mapping substrings
-        # to dictionary offsets.
-        self.d = [{} for i in xrange(0, MAX_REF_LEN + 1)]
-        self.ptr = 0
-
-        # For each reference length there is also a reverse dictionary
-        # mapping dictionary offsets to substrings. This makes removing
-        # dictionary entries more efficient.
-        self.r = [{} for i in xrange(0, MAX_REF_LEN + 1)]
-
-    # Add all initial substrings of a string to the dictionary.
-    def add(self, s):
-        maxLength = MAX_REF_LEN
-        if maxLength > len(s):
-            maxLength = len(s)
-
-        offset = self.ptr
-
-        # Generate all substrings
-        for length in xrange(MIN_REF_LEN, maxLength + 1):
-            substr = s[:length]
-
-            # Remove obsolete mapping, if present
-            try:
-                prevOffset = self.d[length][substr]
-                del self.r[length][prevOffset]
-            except KeyError:
-                pass
-
-            try:
-                prevSubstr = self.r[length][offset]
-                del self.d[length][prevSubstr]
-            except KeyError:
-                pass
-
-            # Add new mapping
-            self.d[length][substr] = offset
-            self.r[length][offset] = substr
-
-        # Advance dictionary pointer
-        self.ptr = (self.ptr + 1) & WMASK
-
-    # Find any of the initial substrings of a string in the dictionary,
-    # looking for long matches first. Returns an (offset, length) tuple if
-    # found. Raises KeyError if not found.
-    def find(self, s):
-        maxLength = MAX_REF_LEN
-        if maxLength > len(s):
-            maxLength = len(s)
-
-        for length in xrange(maxLength, MIN_REF_LEN - 1, -1):
-            substr = s[:length]
-
-            try:
-                offset = self.d[length][substr]
-                if offset != self.ptr:  # the FF7 LZSS decompressor can't handle this case
-                    return (offset, length)
-            except KeyError:
-                pass
-
-        raise KeyError
-
-
-# Compress an 8-bit string to LZSS format.
-def compress(data):
-    dictionary = Dictionary()
-
-    # Prime the dictionary
-    dictionary.ptr = WSIZE - 2*MAX_REF_LEN
-    for i in xrange(MAX_REF_LEN):
-        dictionary.add('\0' * (MAX_REF_LEN - i) + data[:i])
+        items.append(match)
 
-    # Output data
-    output = ""
+        finder.insert(length)
+        i += length
+
+    return items
+
+
+# Parse the data into literals and references, emitting a literal instead
+# of a match if the match at the next position is longer.
+def _parseLazy(finder, dataSize):
+    items = []
 
     i = 0
-    dataSize = len(data)
+    match = finder.find()
+
+    while i < dataSize:
+        if match is None:
+
+            # Literal
+            items.append(None)
+            finder.insert(1)
+            i += 1
+
+            match = finder.find()
+            continue
 
+        length = match[1]
+        finder.insert(1)
+
+        if length < MAX_REF_LEN:
+
+            # Better match at the next position? Then emit a literal instead.
+            nextMatch = finder.find()
+            if nextMatch is not None and nextMatch[1] > length:
+                items.append(None)
+                i += 1
+
+                match = nextMatch
+                continue
+
+        # Reference
+        items.append(match)
+        finder.insert(length - 1)
+        i += length
+
+        match = finder.find()
+
+    return items
+
+
+# Parse the data into literals and references such that the compressed
+# output becomes as small as possible.
+def _parseOptimal(finder, dataSize):
+
+    # Find the longest match at every position
+    matches = []
+    for i in xrange(dataSize):
+        matches.append(finder.find())
+        finder.insert(1)
+
+    # Every item costs one byte (literal) or two bytes (reference), and
+    # every group of 8 items is preceded by a flags byte. cost[i][m] is the
+    # minimum size of the output for the data starting at position i, with
+    # m items already present in the current group.
+    cost = [None] * (dataSize + 1)
+    cost[dataSize] = [0] * 8
+
+    for i in xrange(dataSize - 1, -1, -1):
+
+        # Literal
+        next = cost[i + 1]
+        row = [c + 1 for c in next[1:] + next[:1]]
+
+        # References of all possible lengths
+        match = matches[i]
+        if match is not None:
+            maxLength = match[1]
+
+            refCost = cost[i + MIN_REF_LEN]
+            for length in xrange(MIN_REF_LEN + 1, maxLength + 1):
+                refCost = map(min, refCost, cost[i + length])
+
+            row = map(min, row, [c + 2 for c in refCost[1:] + refCost[:1]])
+
+        row[0] += 1  # flags byte at the start of a group
+        cost[i] = row
+
+    # Follow the cheapest path through the data, preferring long references
+    items = []
+
+    i = 0
+    m = 0
     while i < dataSize:
+        target = cost[i][m] - (m == 0)
+        nextM = (m + 1) & 7
+
+        match = matches[i]
+        length = 1
+
+        if match is not None:
+            for refLength in xrange(match[1], MIN_REF_LEN - 1, -1):
+                if cost[i + refLength][nextM] + 2 == target:
+                    length = refLength
+                    break
+
+        if length > 1:
+            items.append((match[0], length))
+        else:
+            items.append(None)
+
+        i += length
+        m = nextM
+
+    return items
+
+
+# Compress an 8-bit string to LZSS format, using the given compression level.
+def compress(data, level = FAST):
+    finder = MatchFinder(data)
+    dataSize = len(data)
+
+    # Split the data into literals (None) and (offset, length) references
+    if level == FAST:
+        items = _parseGreedy(finder, dataSize)
+    elif level == LAZY:
+        items = _parseLazy(finder, dataSize)
+    elif level == OPTIMAL:
+        items = _parseOptimal(finder, dataSize)
+    else:
+        raise ValueError, "Invalid LZSS compression level %r" % level
+
+    # Output data
+    output = bytearray()
+
+    i = 0
+    numItems = len(items)
+
+    for first in xrange(0, numItems, 8):
 
         # Accumulated output chunk
-        accum = ""
+        accum = bytearray()
 
         # Process 8 literals or references at a time
         flags = 0
-        for bit in xrange(8):
-            if i >= dataSize:
-                break
+        for bit in xrange(min(8, numItems - first)):
+            item = items[first + bit]
 
-            # Next substring in dictionary?
-            try:
-                substr = data[i:i + MAX_REF_LEN]
-                offset, length = dictionary.find(substr)
+            if item is not None:
 
-                # Yes, append dictionary reference
-                accum += chr(offset & 0xff) + chr(((offset >> 4) & 0xf0) | (length - MIN_REF_LEN))
+                # Append dictionary reference
+                offset, length = item
+                accum.append(offset & 0xff)
+                accum.append(((offset >> 4) & 0xf0) | (length - MIN_REF_LEN))
 
-                # Update dictionary
-                for j in xrange(length):
-                    dictionary.add(data[i + j:i + j + MAX_REF_LEN])
-
-                i += length
-
-            except KeyError:
+            else:
 
                 # Append literal value
-                v = data[i]
-                accum += v
+                length = 1
+                accum += data[i]
 
                 flags |= (1 << bit)
 
-                # Update dictionary
-                dictionary.add(data[i:i + MAX_REF_LEN])
-
-                i += 1
+            i += length
 
         # Chunk complete, add to output
-        output += chr(flags)
+        output.append(flags)
         output += accum
 
-    return output
+    return str(output)
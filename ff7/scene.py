@@ -10,9 +10,11 @@
 
 import struct
 import gzip
+import zlib
 import StringIO
 
 import ff7
+import ff7text
 
 
 def _enum(**enums):
@@ -239,28 +241,30 @@ class Scene:
 
     # Return the enemy names defined in the scene.
     def getEnemyNames(self, japanese = False):
-        enemies = []
+        rawStrings = []
 
         for i in xrange(3):
             offset = self.enemyDataOffset + i * self.enemyDataSize
-            enemies.append(ff7.decodeKernelText(self.data[offset:offset + self.maxStringSize], japanese))
+            rawStrings.append(self.data[offset:offset + self.maxStringSize])
 
-        return enemies
+        return ff7text.decodeMany(rawStrings, False, japanese)
 
     # Return the ability names defined in the scene.
     def getAbilityNames(self, japanese = False):
-        abilities = []
+        rawStrings = []
 
         for i in xrange(32):
             offset = self.abilitiesOffset + i * self.maxStringSize
-            abilities.append(ff7.decodeKernelText(self.data[offset:offset + self.maxStringSize], japanese))
+            rawStrings.append(self.data[offset:offset + self.maxStringSize])
 
-        return abilities
+        return ff7text.decodeMany(rawStrings, False, japanese)
 
     # Set the enemy names.
     def setEnemyNames(self, enemies, japanese = False):
+        rawStrings = ff7text.encodeMany(enemies[:3], False, japanese)
+
         for i in xrange(3):
-            rawString = ff7.encodeKernelText(enemies[i], japanese)
+            rawString = rawStrings[i]
             rawStringSize = len(rawString)
 
             if rawStringSize > self.maxStringSize:
@@ -274,8 +278,10 @@ class Scene:
 
     # Set the ability names.
     def setAbilityNames(self, abilities, japanese = False):
+        rawStrings = ff7text.encodeMany(abilities[:32], False, japanese)
+
         for i in xrange(32):
-            rawString = ff7.encodeKernelText(abilities[i], japanese)
+            rawString = rawStrings[i]
             rawStringSize = len(rawString)
 
             if rawStringSize > self.maxStringSize:
@@ -289,7 +295,7 @@ class Scene:
 
     # Return the list of message strings in the scene scripts.
     def getStrings(self, japanese = False):
-        strings = []
+        rawStrings = []
 
         for scriptsOfEnemy in self.enemyScripts:
             if scriptsOfEnemy is None:
@@ -301,13 +307,13 @@ class Scene:
 
                 for instr in script:
                     if instr.op == Op.MES:
-                        rawString = str(instr.code[1:])
-                        strings.append(ff7.decodeKernelText(rawString, japanese))
+                        rawStrings.append(str(instr.code[1:]))
 
-        return strings
+        return ff7text.decodeMany(rawStrings, False, japanese)
 
     # Replace the message strings in the scene scripts.
     def setStrings(self, strings, japanese = False):
+        rawStrings = ff7text.encodeMany(strings, False, japanese)
         currentString = 0
 
         for scriptsOfEntity in self.enemyScripts:
@@ -341,8 +347,7 @@ class Scene:
                 # Replace the strings in all MES instructions
                 for index in xrange(len(script)):
                     if script[index].op == Op.MES:
-                        rawString = ff7.encodeKernelText(strings[currentString], japanese)
-                        script[index].setArg(rawString)
+                        script[index].setArg(rawStrings[currentString])
                         currentString += 1
 
                 # Recalculate all instruction offsets
@@ -362,27 +367,79 @@ class Scene:
         self.insertScripts(self.enemyScripts, self.aiDataOffset, 3, len(self.data))
 
 
+# Pad compressed scene data to a 4-byte boundary.
+def _padScene(cmpData):
+    if len(cmpData) % 4 != 0:
+        cmpData += '\xff' * (4 - len(cmpData) % 4)  # pad scene to 4-byte boundary
+
+    return cmpData
+
+
+# Compress a scene for storing it in the archive.
+def _compressScene(data):
+    return _padScene(ff7.compressGzip(data))
+
+
+# zlib parameters tried for finding the smallest compressed scene
+_strategies = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_HUFFMAN_ONLY]
+_memLevels = range(1, 10)
+_windowBits = range(9, 16)
+
+
+# Compress a scene with all combinations of zlib parameters and return the
+# smallest result.
+def _compressSceneSmallest(data):
+    best = None
+
+    for strategy in _strategies:
+        for memLevel in _memLevels:
+            for windowBits in _windowBits:
+                cmpData = ff7.compressGzip(data, memLevel, strategy, windowBits)
+                if best is None or len(cmpData) < len(best):
+                    best = cmpData
+
+    return _padScene(best)
+
+
 # Battle scene archive file (SCENE.BIN)
 class Archive:
     blockSize = 0x2000
     pointerTableSize = 0x40
     maxSceneSize = 0x1e80  # maximum size of uncompressed scene
 
-    # Parse the scene archive from an open file object.
-    def __init__(self, fileobj):
-
-        self.sceneData = []
+    # Parse the scene archive from an open file object. In lazy mode, only
+    # the pointer tables are read, and scenes are read and decompressed
+    # when they are first accessed. The file object must then be seekable
+    # and stay open while the archive is in use.
+    def __init__(self, fileobj, lazy = False):
+        self.fileobj = fileobj
+
+        self.sceneLocations = []   # (file offset, size) of each compressed scene in the file
+        self.cmpSceneData = []     # compressed scene data, None if not read yet or changed
+        self.sceneData = []        # decompressed scene data, None if not decompressed yet
+        self.sceneChanged = []     # flag for each scene whether it was replaced
         self.sceneIndexTable = []  # index of first scene in each block
 
         sceneIndex = 0
+        blockOffset = 0
 
         # Read all blocks
         while True:
 
-            # Read the next block
-            block = fileobj.read(self.blockSize)
-            if len(block) < self.blockSize:
-                break
+            # Read the next block (only its pointer table in lazy mode)
+            if lazy:
+                fileobj.seek(blockOffset)
+                block = fileobj.read(self.pointerTableSize)
+
+                # Check that the block is complete
+                fileobj.seek(blockOffset + self.blockSize - 1)
+                if len(block) < self.pointerTableSize or len(fileobj.read(1)) < 1:
+                    break
+
+            else:
+                block = fileobj.read(self.blockSize)
+                if len(block) < self.blockSize:
+                    break
 
             # Parse the pointer table
             pointers = struct.unpack_from("<16L", block)
@@ -399,43 +456,120 @@ class Archive:
 
             self.sceneIndexTable.append(sceneIndex)
 
-            # Extract all scenes in the block
+            # Index all scenes in the block
             for i in xrange(numScenes):
                 start = offsets[i]
                 end = offsets[i + 1]
                 assert end >= start
 
-                buffer = StringIO.StringIO(block[start:end].rstrip('\xff'))
-                zipper = gzip.GzipFile(fileobj = buffer, mode = "rb")
-                scene = zipper.read(self.maxSceneSize)
+                self.sceneLocations.append((blockOffset + start, end - start))
+                self.sceneChanged.append(False)
+
+                if lazy:
+                    self.cmpSceneData.append(None)
+                    self.sceneData.append(None)
+                else:
+                    cmpData = block[start:end]
+                    self.cmpSceneData.append(cmpData)
+                    self.sceneData.append(self.decompressScene(cmpData))
 
-                self.sceneData.append(scene)
                 sceneIndex += 1
 
+            blockOffset += self.blockSize
+
+        # Remember the original number of blocks
+        self.originalNumBlocks = len(self.sceneIndexTable)
+
+    # Decompress scene data as stored in a block.
+    def decompressScene(self, cmpData):
+        buffer = StringIO.StringIO(cmpData.rstrip('\xff'))
+        zipper = gzip.GzipFile(fileobj = buffer, mode = "rb")
+        return zipper.read(self.maxSceneSize)
+
+    # Return the compressed data of the scene with the given index as stored
+    # in the original file, including padding.
+    def getCmpSceneData(self, index):
+        if self.cmpSceneData[index] is None:
+            offset, size = self.sceneLocations[index]
+
+            self.fileobj.seek(offset)
+            self.cmpSceneData[index] = self.fileobj.read(size)
+
+        return self.cmpSceneData[index]
+
+    # Return the decompressed data of the scene with the given index.
+    def getSceneData(self, index):
+        if self.sceneData[index] is None:
+            self.sceneData[index] = self.decompressScene(self.getCmpSceneData(index))
+
+        return self.sceneData[index]
+
     # Return the number of scenes (should be 256).
     def numScenes(self):
         return len(self.sceneData)
 
+    # Return the number of blocks of the archive (as last read or written).
+    def numBlocks(self):
+        return len(self.sceneIndexTable)
+
     # Return the scene with the given index.
     def getScene(self, index):
-        return Scene(self.sceneData[index], index)
+        return Scene(self.getSceneData(index), index)
 
     # Replace the scene with the given index.
     def setScene(self, index, scene):
-        self.sceneData[index] = scene.getData()
+        data = scene.getData()
+
+        if data != self.getSceneData(index):
+            self.sceneData[index] = data
+            self.cmpSceneData[index] = None
+            self.sceneChanged[index] = True
+
+    # Write the archive to a file object, truncating the file. Unchanged
+    # scenes keep their original compressed data. If 'optimize' is true,
+    # all scenes are recompressed with different zlib parameters to find
+    # the smallest representation of each one. If 'workers' is greater than
+    # 1, the scenes are compressed in parallel by that many processes.
+    def writeToFile(self, fileobj, workers = 1, optimize = False):
+        numScenes = len(self.sceneData)
 
-    # Write the archive to a file object, truncating the file.
-    def writeToFile(self, fileobj):
+        # Gather the compressed scenes (the gzip trailer of a scene ends
+        # with the upper byte of the uncompressed size, which is 0, so the
+        # padding can be safely stripped from the original data)
+        cmpScenes = []
+        for sceneIndex in xrange(numScenes):
+            if self.sceneChanged[sceneIndex]:
+                cmpScenes.append(None)
+            else:
+                cmpScenes.append(_padScene(self.getCmpSceneData(sceneIndex).rstrip('\xff')))
+
+        if optimize:
+
+            # Compress all scenes, keeping the original data if it is smaller
+            results = ff7.parallelMap(_compressSceneSmallest, [self.getSceneData(i) for i in xrange(numScenes)], workers)
+
+            for sceneIndex, cmpData in enumerate(results):
+                if cmpScenes[sceneIndex] is None or len(cmpData) < len(cmpScenes[sceneIndex]):
+                    cmpScenes[sceneIndex] = cmpData
+
+        else:
+
+            # Compress the changed scenes
+            changed = [i for i in xrange(numScenes) if self.sceneChanged[i]]
+            results = ff7.parallelMap(_compressScene, [self.sceneData[i] for i in changed], workers)
+
+            for sceneIndex, cmpData in zip(changed, results):
+                cmpScenes[sceneIndex] = cmpData
 
         # Truncate file
         fileobj.seek(0)
         fileobj.truncate()
 
-        # Scene index table will be rebuilt
+        # Scene index table and locations will be rebuilt
         self.sceneIndexTable = []
+        self.sceneLocations = []
 
         sceneIndex = 0
-        numScenes = len(self.sceneData)
 
         # Process all scenes
         block = ""
@@ -453,14 +587,14 @@ class Archive:
 
             else:
 
-                # Compress next scene
-                cmpData = ff7.compressGzip(self.sceneData[sceneIndex])
-                if len(cmpData) % 4 != 0:
-                    cmpData += '\xff' * (4 - len(cmpData) % 4)  # pad scene to 4-byte boundary
+                # Get next compressed scene
+                cmpData = cmpScenes[sceneIndex]
 
-                if self.pointerTableSize + len(block) + len(cmpData) > self.blockSize:
+                if self.pointerTableSize + len(block) + len(cmpData) > self.blockSize or len(pointers) >= 16:
 
                     # Scene doesn't fit in current block, write it first
+                    # (filling each block as far as possible yields the
+                    # smallest number of blocks for the given scene order)
                     writeBlock = True
 
             if writeBlock:
@@ -491,6 +625,12 @@ class Archive:
 
                 # Add compressed scene to block
                 pointers.append(len(block) + self.pointerTableSize)
+                self.sceneLocations.append((len(self.sceneIndexTable) * self.blockSize + pointers[-1], len(cmpData)))
                 block += cmpData
 
                 sceneIndex += 1
+
+        # The archive now refers to the written file
+        self.fileobj = fileobj
+        self.cmpSceneData = cmpScenes
+        self.sceneChanged = [False] * numScenes
@@ -53,6 +53,10 @@ class Script:
         dataSize = len(data)
         script = []
 
+        # Text strings are collected and decoded together at the end
+        textLines = []
+        rawStrings = []
+
         i = 0
         while i < dataSize:
             c = data[i]
@@ -78,7 +82,9 @@ class Script:
 
                 # Text string
                 end = data.index('\xff', i)
-                script.append(ff7text.decodeKernel(data[i:end], japanese))
+                textLines.append(len(script))
+                rawStrings.append(data[i:end])
+                script.append(None)
                 i = end + 1
 
             elif c == '\x12':
@@ -100,12 +106,18 @@ class Script:
                 else:
                     raise IndexError, "Illegal opcode %02x in tutorial data" % ord(c)
 
+        for line, text in zip(textLines, ff7text.decodeMany(rawStrings, False, japanese)):
+            script[line] = text
+
         return script
 
     # Assemble tutorial data from list of strings.
     def setScript(self, script, japanese = False):
         data = ""
 
+        # Encode all text lines together
+        rawStrings = iter(ff7text.encodeMany([line for line in script if not line.startswith("{")], False, japanese))
+
         for line in script:
             if line.startswith( "{WAIT" ):
 
@@ -150,6 +162,6 @@ class Script:
             else:
 
                 # Text line
-                data += '\x10' + ff7text.encode(line, False, japanese)
+                data += '\x10' + next(rawStrings)
 
         self.data = data + '\x11'
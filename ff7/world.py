@@ -88,11 +88,12 @@ class WorldMap:
             struct.pack_into("<H", self.data, offset, w)
             offset += 2
 
-    # Write the map to a file object, truncating the file.
-    def writeToFile(self, fileobj):
+    # Write the map to a file object, truncating the file. The 'level'
+    # specifies the LZSS compression level.
+    def writeToFile(self, fileobj, level = lzss.FAST):
 
         # Compress the map data
-        cmpData = lzss.compress(str(self.data))
+        cmpData = lzss.compress(str(self.data), level)
 
         # Write to file
         fileobj.seek(0)